@@ -31,7 +31,15 @@ def create_app(root_injector: Injector) -> FastAPI:
 		retrieval_router,
 	)
 	# Init all the services here
-	root_injector.get(RetrieverServices)
+	retriever_services = root_injector.get(RetrieverServices)
+
+	@app.on_event("startup")
+	async def start_batchers():
+		retriever_services.batcher.start()
+
+	@app.on_event("shutdown")
+	async def stop_batchers():
+		await retriever_services.batcher.stop()
 
 	@app.get("/")
 	async def root():
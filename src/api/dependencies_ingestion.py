@@ -1,7 +1,11 @@
+from os import getenv
+
 from injector import Injector
-from rag.components.shared.databases.settings import MilvusSettings
 
 from src.api.schemas import ModelName
+from src.api.settings import RetrievalSettings
+from src.rag.components.embeddings.cache import EmbeddingCache, SQLiteEmbeddingStore
+from src.rag.components.shared.databases.settings import MilvusSettings
 
 
 def create_application_injector() -> Injector:
@@ -24,6 +28,23 @@ def create_application_injector() -> Injector:
 		ModelName,
 		to=ModelName(embedding_model_name),
 	)
+	_injector.binder.bind(
+		RetrievalSettings,
+		to=RetrievalSettings(max_batch_size=32, max_wait_ms=5.0),
+	)
+	# the disk tier is optional, it lets a warmed cache survive pod restarts
+	embedding_cache_path = getenv("EMBEDDING_CACHE_PATH")
+	_injector.binder.bind(
+		EmbeddingCache,
+		to=EmbeddingCache(
+			max_entries=10_000,
+			ttl_seconds=3600,
+			max_size_mb=256,
+			second_tier=SQLiteEmbeddingStore(embedding_cache_path)
+			if embedding_cache_path
+			else None,
+		),
+	)
 	return _injector
 
 
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List, Union
 
 from fastapi import APIRouter, Request
 from fastapi.encoders import jsonable_encoder
@@ -11,12 +11,26 @@ from src.rag.schemas.document import Node
 router = APIRouter()
 
 
-@router.post("/retrieve", response_model=List[Node])
-def retrieve(request: Request, query: Query) -> JSONResponse:
+@router.post("/retrieve", response_model=Union[List[Node], List[Dict[str, Any]]])
+async def retrieve(request: Request, query: Query) -> JSONResponse:
 	"""retrieve the top k documents from the database given the query"""
 	retriever_services: RetrieverServices = request.state.injector.get(
 		RetrieverServices
 	)
-	retrieved_context = retriever_services.search(query.query)
+	retrieved_context = await retriever_services.asearch(
+		query.query,
+		top_k=query.top_k,
+		search_params=query.search_params,
+		output_fields=query.output_fields,
+	)
 	retrieved_context_json = jsonable_encoder(retrieved_context)
 	return JSONResponse(content=retrieved_context_json, status_code=200)
+
+
+@router.get("/metrics/cache")
+async def cache_metrics(request: Request) -> JSONResponse:
+	"""hit ratio and occupancy of the retrieval caches"""
+	retriever_services: RetrieverServices = request.state.injector.get(
+		RetrieverServices
+	)
+	return JSONResponse(content=retriever_services.cache_stats(), status_code=200)
@@ -1,6 +1,9 @@
-from typing import NewType
+from typing import List, NewType, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
+
+from src.rag.components.shared.databases.settings import MilvusSearchParams
+from src.rag.schemas.document import Node
 
 ModelName = NewType("ModelName", str)
 
@@ -9,3 +12,19 @@ class Query(BaseModel):
 	"""Query model"""
 
 	query: str
+	top_k: int = Field(5, gt=0, le=100)
+	search_params: Optional[MilvusSearchParams] = None
+	output_fields: Optional[List[str]] = Field(
+		None,
+		description="Node fields to return, node_id and score are always included. All the fields by default.",
+	)
+
+	@field_validator("output_fields")
+	def check_output_fields(cls, fields: Optional[List[str]]) -> Optional[List[str]]:
+		"""check that only node fields are requested"""
+		if fields is None:
+			return fields
+		unknown_fields = set(fields) - set(Node.keys())
+		if unknown_fields:
+			raise ValueError(f"Unknown output fields: {sorted(unknown_fields)}")
+		return fields
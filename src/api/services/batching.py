@@ -0,0 +1,120 @@
+import asyncio
+from typing import Any, Callable, Generic, List, Optional, Tuple, TypeVar
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("micro_batcher")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+	"""
+	Collect items submitted concurrently and process them in a single call.
+
+	Items that arrive within `max_wait_ms` of the first item of a batch, up to
+	`max_batch_size` items, are handed to `batch_function` together. The
+	function runs in the default thread pool so the event loop stays free, and
+	each result is fanned back out to the coroutine that submitted the item.
+	"""
+
+	def __init__(
+		self,
+		batch_function: Callable[[List[T]], List[R]],
+		max_batch_size: int = 32,
+		max_wait_ms: float = 5.0,
+	):
+		"""
+		Args:
+		    batch_function: Function mapping a list of items to a list of results of the same length
+		    max_batch_size: Maximum number of items processed in one call
+		    max_wait_ms: Maximum time to wait for a batch to fill up, in milliseconds
+		"""
+		self.batch_function = batch_function
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait_ms / 1000
+		self._queue: Optional[asyncio.Queue] = None
+		self._worker: Optional[asyncio.Task] = None
+
+	@property
+	def is_running(self) -> bool:
+		return self._worker is not None and not self._worker.done()
+
+	def start(self) -> None:
+		"""Start the background worker on the running event loop."""
+		if self.is_running:
+			return
+		self._queue = asyncio.Queue()
+		self._worker = asyncio.get_running_loop().create_task(self._run())
+		logger.info(
+			f"Micro batcher started with max_batch_size={self.max_batch_size} and max_wait={self.max_wait * 1000} ms"
+		)
+
+	async def stop(self) -> None:
+		"""Stop the background worker, failing the items still waiting in the queue."""
+		if not self.is_running:
+			return
+		self._worker.cancel()
+		try:
+			await self._worker
+		except asyncio.CancelledError:
+			pass
+		while not self._queue.empty():
+			_, future = self._queue.get_nowait()
+			if not future.done():
+				future.set_exception(RuntimeError("Micro batcher stopped."))
+		self._worker = None
+		logger.info("Micro batcher stopped.")
+
+	async def submit(self, item: T) -> R:
+		"""Submit an item and wait for its result."""
+		if not self.is_running:
+			self.start()
+		future = asyncio.get_running_loop().create_future()
+		await self._queue.put((item, future))
+		return await future
+
+	async def _collect_batch(self) -> List[Tuple[T, asyncio.Future]]:
+		"""Wait for the first item, then gather more until the batch is full or the window closes."""
+		batch = [await self._queue.get()]
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + self.max_wait
+		while len(batch) < self.max_batch_size:
+			remaining = deadline - loop.time()
+			if remaining <= 0:
+				break
+			try:
+				batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+			except asyncio.TimeoutError:
+				break
+		return batch
+
+	async def _run(self) -> None:
+		loop = asyncio.get_running_loop()
+		while True:
+			batch = await self._collect_batch()
+			items = [item for item, _ in batch]
+			futures = [future for _, future in batch]
+			try:
+				results = await loop.run_in_executor(None, self.batch_function, items)
+			except Exception as e:
+				logger.error(f"Batch of {len(items)} items failed: {str(e)}")
+				self._set_results(futures, exception=e)
+				continue
+			self._set_results(futures, results=results)
+
+	@staticmethod
+	def _set_results(
+		futures: List[asyncio.Future],
+		results: Optional[List[Any]] = None,
+		exception: Optional[Exception] = None,
+	) -> None:
+		for index, future in enumerate(futures):
+			# the caller may have been cancelled while the batch was running
+			if future.done():
+				continue
+			if exception is not None:
+				future.set_exception(exception)
+			else:
+				future.set_result(results[index])
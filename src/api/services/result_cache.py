@@ -0,0 +1,148 @@
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+from src.rag.schemas.document import Node
+from src.shared.logger import setup_logger
+
+logger = setup_logger("semantic_result_cache")
+
+
+class SemanticResultCache:
+	"""
+	Cache of retrieval results looked up by query embedding similarity.
+
+	The embeddings of the most recently served queries are kept in a fixed size
+	ring buffer. A new query reuses the results of the closest cached query when
+	their cosine similarity is above `similarity_threshold`. The buffer is small,
+	so the nearest neighbour is found with one matrix-vector product instead of
+	a dedicated ANN index.
+
+	Entries are tagged with the collection generation they were computed
+	against and the whole cache is dropped when the generation changes.
+	They are also tagged with the search options of the query, such as the
+	search params, and only serve queries with the same options.
+	"""
+
+	def __init__(
+		self,
+		vector_dimension: int,
+		similarity_threshold: float = 0.97,
+		max_entries: int = 1024,
+		ttl_seconds: Optional[float] = 600,
+	):
+		"""
+		Args:
+		    vector_dimension: Dimension of the query embeddings
+		    similarity_threshold: Minimum cosine similarity to reuse cached results
+		    max_entries: Number of recent queries kept in the cache
+		    ttl_seconds: Time after which an entry is not served anymore, None to never expire
+		"""
+		self.vector_dimension = vector_dimension
+		self.similarity_threshold = similarity_threshold
+		self.max_entries = max_entries
+		self.ttl_seconds = ttl_seconds
+		self.generation: Optional[str] = None
+		self._vectors = np.zeros((max_entries, vector_dimension), dtype=np.float32)
+		self._results: List[Optional[List[Node]]] = [None] * max_entries
+		self._inserted_at = np.zeros(max_entries, dtype=np.float64)
+		# the options of each entry, stored as small ids so they are compared in one vectorized test
+		self._option_ids = np.zeros(max_entries, dtype=np.int64)
+		self._options: Dict[Hashable, int] = {}
+		self._size = 0
+		self._next_slot = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	def lookup(
+		self, query_vector: Sequence[float], top_k: int, options: Hashable = None
+	) -> Optional[List[Node]]:
+		"""Return the cached top k nodes of the closest recent query run with the same options, or None on a miss."""
+		query_vector = self._normalize(query_vector)
+		with self._lock:
+			option_id = self._options.get(options)
+			if self._size and option_id is not None:
+				similarities = self._vectors[: self._size] @ query_vector
+				similarities[self._option_ids[: self._size] != option_id] = -np.inf
+				if self.ttl_seconds is not None:
+					expired = (
+						time.monotonic() - self._inserted_at[: self._size]
+						> self.ttl_seconds
+					)
+					similarities[expired] = -np.inf
+				best = int(np.argmax(similarities))
+				results = self._results[best]
+				if (
+					similarities[best] >= self.similarity_threshold
+					and len(results) >= top_k
+				):
+					self.hits += 1
+					return results[:top_k]
+			self.misses += 1
+			return None
+
+	def store(
+		self,
+		query_vector: Sequence[float],
+		results: List[Node],
+		options: Hashable = None,
+	) -> None:
+		"""Cache the results served for the query with its options, evicting the oldest entry when full."""
+		query_vector = self._normalize(query_vector)
+		with self._lock:
+			slot = self._next_slot
+			self._vectors[slot] = query_vector
+			self._results[slot] = results
+			self._option_ids[slot] = self._options.setdefault(
+				options, len(self._options)
+			)
+			self._inserted_at[slot] = time.monotonic()
+			self._next_slot = (slot + 1) % self.max_entries
+			self._size = min(self._size + 1, self.max_entries)
+
+	def set_generation(self, generation: Optional[str]) -> None:
+		"""Record the collection generation, clearing the cache when it changed."""
+		with self._lock:
+			if generation == self.generation:
+				return
+			if self._size:
+				self.invalidations += 1
+				logger.info(
+					f"Collection generation changed from {self.generation} to {generation}, dropping {self._size} cached results."
+				)
+			self.generation = generation
+			self._clear()
+
+	def clear(self) -> None:
+		with self._lock:
+			self._clear()
+
+	@property
+	def stats(self) -> Dict[str, float]:
+		"""Hit ratio and occupancy of the cache."""
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_ratio": self.hits / lookups if lookups else 0.0,
+				"entries": self._size,
+				"invalidations": self.invalidations,
+				"generation": self.generation,
+			}
+
+	def _clear(self) -> None:
+		self._results = [None] * self.max_entries
+		self._options = {}
+		self._size = 0
+		self._next_slot = 0
+
+	@staticmethod
+	def _normalize(vector: Sequence[float]) -> np.ndarray:
+		vector = np.asarray(vector, dtype=np.float32)
+		norm = np.linalg.norm(vector)
+		return vector / norm if norm else vector
@@ -1,46 +1,212 @@
-from typing import List
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 from injector import inject, singleton
 
+from src.api.services.batching import MicroBatcher
+from src.api.services.result_cache import SemanticResultCache
+from src.api.settings import RetrievalSettings
 from src.rag.components.embeddings.embeddings import EmbeddingComputer
 from src.rag.components.shared.databases.milvus import MilvusDatabase
+from src.rag.components.shared.databases.settings import MilvusSearchParams
 from src.rag.schemas.document import Node
 from src.shared.logger import setup_logger
 
 logger = setup_logger("retriever_services")
 
 
+class SearchRequest(NamedTuple):
+	query: str
+	top_k: int
+	search_params: Optional[MilvusSearchParams] = None
+	output_fields: Optional[Tuple[str, ...]] = None
+
+
+# a retrieved result is a full node, or only the requested fields of the node
+SearchResult = Union[Node, Dict[str, Any]]
+
+
 @singleton
 class RetrieverServices:
 	@inject
 	def __init__(
-		self, milvus_client: MilvusDatabase, embedding_computer: EmbeddingComputer
+		self,
+		milvus_client: MilvusDatabase,
+		embedding_computer: EmbeddingComputer,
+		retrieval_settings: RetrievalSettings,
 	):
 		# later we can customize this to handle multiple databases.
 		self.milvus_client = milvus_client
 		self.embedding_computer = embedding_computer
+		self.settings = retrieval_settings
+		self.result_cache = SemanticResultCache(
+			vector_dimension=milvus_client.vector_dimension,
+			similarity_threshold=retrieval_settings.result_cache_similarity_threshold,
+			max_entries=retrieval_settings.result_cache_size,
+			ttl_seconds=retrieval_settings.result_cache_ttl_seconds,
+		)
+		self._generation_checked_at = float("-inf")
+		self.batcher: MicroBatcher[SearchRequest, List[SearchResult]] = MicroBatcher(
+			batch_function=self.search_batch,
+			max_batch_size=retrieval_settings.max_batch_size,
+			max_wait_ms=retrieval_settings.max_wait_ms,
+		)
 		logger.info("Retriever services initialized.")
 
-	def search(self, query: str, top_k: int = 5) -> List[Node]:
+	def search(
+		self,
+		query: str,
+		top_k: int = 5,
+		search_params: Optional[MilvusSearchParams] = None,
+		output_fields: Optional[Sequence[str]] = None,
+	) -> List[SearchResult]:
 		"""retrieve the top k documents from the database given the query"""
-		query_embedding = self.embedding_computer.compute_single_text_embedding(
-			f"query : {query}"
-		)
-		retrieved_context = self.milvus_client.search(
-			query_vector=query_embedding,
+		return self.search_many(
+			[query],
 			top_k=top_k,
+			search_params=search_params,
+			output_fields=output_fields,
 		)[0]
-		results = self.post_process_retrieved_context(retrieved_context)
+
+	async def asearch(
+		self,
+		query: str,
+		top_k: int = 5,
+		search_params: Optional[MilvusSearchParams] = None,
+		output_fields: Optional[Sequence[str]] = None,
+	) -> List[SearchResult]:
+		"""retrieve the top k documents, batching the query with concurrent requests"""
+		return await self.batcher.submit(
+			SearchRequest(
+				query=query,
+				top_k=top_k,
+				search_params=search_params,
+				output_fields=tuple(output_fields) if output_fields else None,
+			)
+		)
+
+	def search_batch(self, requests: List[SearchRequest]) -> List[List[SearchResult]]:
+		"""run a batch of search requests, one encode and one milvus search call per distinct search options"""
+		requests_by_options = defaultdict(list)
+		for index, request in enumerate(requests):
+			requests_by_options[(request.search_params, request.output_fields)].append(
+				index
+			)
+
+		results: List[Optional[List[SearchResult]]] = [None] * len(requests)
+		for (search_params, output_fields), indices in requests_by_options.items():
+			max_top_k = max(requests[index].top_k for index in indices)
+			group_results = self.search_many(
+				[requests[index].query for index in indices],
+				top_k=max_top_k,
+				search_params=search_params,
+				output_fields=output_fields,
+			)
+			# results are sorted by score, so the smaller top_k are prefixes
+			for index, result in zip(indices, group_results, strict=True):
+				results[index] = result[: requests[index].top_k]
+		return results
+
+	def search_many(
+		self,
+		queries: List[str],
+		top_k: int = 5,
+		search_params: Optional[MilvusSearchParams] = None,
+		output_fields: Optional[Sequence[str]] = None,
+	) -> List[List[SearchResult]]:
+		"""retrieve the top k documents for each query.
+
+		The search runs in two phases: milvus first returns only the ids and scores of the hits,
+		then the payload is fetched for the final hits only. With `output_fields`, only those
+		fields are fetched and the results are plain dictionaries instead of nodes.
+		"""
+		query_embeddings = self.embedding_computer.compute_texts_embeddings(
+			queries, prefix="query : "
+		)
+		self.refresh_collection_generation()
+		results: List[Optional[List[SearchResult]]] = []
+		for query_embedding in query_embeddings:
+			cached_nodes = self.result_cache.lookup(
+				query_embedding, top_k, options=search_params
+			)
+			if cached_nodes is not None and output_fields is not None:
+				cached_nodes = [
+					self.project_node(node, output_fields) for node in cached_nodes
+				]
+			results.append(cached_nodes)
+		missing_indices = [
+			index for index, result in enumerate(results) if result is None
+		]
+		if not missing_indices:
+			return results
+
+		hits = self.milvus_client.search_ids(
+			query_vector=[query_embeddings[index] for index in missing_indices],
+			top_k=top_k,
+			search_params=search_params,
+		)
+		if not hits:
+			hits = [[] for _ in missing_indices]
+		# a single fetch for the payload of every hit of the batch
+		node_ids = {node_id for query_hits in hits for node_id, _ in query_hits}
+		entities = self.milvus_client.fetch_entities(
+			list(node_ids), output_fields=output_fields
+		)
+		for index, query_hits in zip(missing_indices, hits):
+			results[index] = self.hydrate_hits(query_hits, entities, output_fields)
+			# only full nodes are cached, empty results usually mean milvus failed
+			if output_fields is None and results[index]:
+				self.result_cache.store(
+					query_embeddings[index], results[index], options=search_params
+				)
+		return results
+
+	@staticmethod
+	def hydrate_hits(
+		hits: List[Tuple[str, float]],
+		entities: Dict[str, Dict[str, Any]],
+		output_fields: Optional[Sequence[str]] = None,
+	) -> List[SearchResult]:
+		"""build the results of one query from its (node_id, score) hits and the fetched payloads"""
+		results = []
+		for node_id, score in hits:
+			entity = entities.get(node_id)
+			if entity is None:
+				# the node was deleted between the two phases
+				continue
+			if output_fields is None:
+				results.append(Node.from_milvus_entity(entity, score=score))
+			else:
+				results.append(
+					Node.project_milvus_entity(entity, output_fields, score=score)
+				)
 		return results
 
-	def post_process_retrieved_context(
-		self, retrieved_context: List[Node]
-	) -> List[Node]:
-		"""post process the retrieved context and return a list of dictionaries with the text , and metadata"""
-		responses = []
-
-		for results in retrieved_context:
-			entity = results.entity
-			node = Node.from_milvus_entity(entity)
-			responses.append(node)
-		return responses
+	@staticmethod
+	def project_node(node: Node, output_fields: Sequence[str]) -> Dict[str, Any]:
+		"""keep only the requested fields of a node"""
+		return node.model_dump(
+			mode="json", include={"node_id", "score", *output_fields}
+		)
+
+	def refresh_collection_generation(self) -> None:
+		"""drop the cached results when new data was written to the collection"""
+		now = time.monotonic()
+		if now - self._generation_checked_at < self.settings.generation_refresh_seconds:
+			return
+		self._generation_checked_at = now
+		try:
+			generation = self.milvus_client.get_collection_generation()
+		except Exception as e:
+			# a transient error is not a change, the last known generation is kept
+			logger.warning(f"Failed to read the collection generation: {str(e)}")
+			return
+		self.result_cache.set_generation(generation)
+
+	def cache_stats(self) -> Dict[str, Dict]:
+		"""hit ratio of the caches used on the query path"""
+		stats = {"result_cache": self.result_cache.stats}
+		if self.embedding_computer.cache is not None:
+			stats["embedding_cache"] = self.embedding_computer.cache.stats
+		return stats
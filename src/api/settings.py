@@ -1,29 +1,35 @@
 from pydantic import BaseModel, Field
 
 
-class MilvusSettings(BaseModel):
-	uri: str = Field(
-		"local_data/private_gpt/milvus/milvus_local.db",
-		description="The URI of the Milvus instance. For example: 'local_data/private_gpt/milvus/milvus_local.db' for Milvus Lite.",
+class RetrievalSettings(BaseModel):
+	max_batch_size: int = Field(
+		32,
+		description="Maximum number of queries encoded and searched together in one batch.",
+		gt=0,
 	)
-	token: str = Field(
-		"",
-		description=(
-			"A valid access token to access the specified Milvus instance. "
-			"This can be used as a recommended alternative to setting user and password separately. "
-		),
+	max_wait_ms: float = Field(
+		5.0,
+		description="Maximum time in milliseconds to wait for more queries before running a batch.",
+		ge=0,
 	)
-	collection_name: str = Field(
-		"make_this_parameterizable_per_api_call",
-		description="The name of the collection in Milvus. Default is 'make_this_parameterizable_per_api_call'.",
+	result_cache_similarity_threshold: float = Field(
+		0.97,
+		description="Minimum cosine similarity between two queries to reuse cached retrieval results.",
+		gt=0,
+		le=1,
 	)
-	overwrite: bool = Field(
-		True, description="Overwrite the previous collection schema if it exists."
-	)
-	vector_dimension: int = Field(
+	result_cache_size: int = Field(
 		1024,
-		description=(
-			"The dimension of the vector. "
-			"This should match the dimension of the embeddings used in the collection."
-		),
+		description="Number of recent queries kept in the semantic result cache.",
+		gt=0,
+	)
+	result_cache_ttl_seconds: float = Field(
+		600,
+		description="Time after which a cached retrieval result is not served anymore.",
+		gt=0,
+	)
+	generation_refresh_seconds: float = Field(
+		30,
+		description="Interval between two checks of the collection generation.",
+		ge=0,
 	)
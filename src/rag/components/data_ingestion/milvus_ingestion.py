@@ -2,8 +2,9 @@
 import argparse
 from pathlib import Path
 
-from rag.components.shared.databases.settings import MilvusSettings
 from src.rag.components.shared.databases.milvus import MilvusDatabase
+from src.rag.components.shared.databases.settings import MilvusSettings
+from src.rag.components.shared.embedding_matrix import EmbeddingMatrix
 from src.rag.components.shared.io import IOManager
 from src.shared.logger import setup_logger
 
@@ -16,10 +17,13 @@ if __name__ == "__main__":
 		description="Process documents and compute embeddings."
 	)
 	parser.add_argument(
+		"--batch_size",
+		# deprecated alias, it counted documents and now counts nodes
 		"--chunk_size",
+		dest="batch_size",
 		type=int,
-		default=100,
-		help="Number of documents to load at a time.",
+		default=1000,
+		help="Number of nodes written to Milvus at a time, --chunk_size is a deprecated alias.",
 	)
 
 	# document path argument
@@ -48,12 +52,57 @@ if __name__ == "__main__":
 		default=None,
 		help="Number of documents to process.",
 	)
+	parser.add_argument(
+		"--node_format",
+		type=str,
+		choices=["json", "parquet"],
+		default="json",
+		help="Format of the node files, the parquet embeddings are read without copy.",
+	)
+	parser.add_argument(
+		"--embedding_matrix_path",
+		type=str,
+		default=None,
+		help="Folder of the memory mapped embedding matrices, when the node files have no embeddings.",
+	)
+	parser.add_argument(
+		"--shard_index",
+		type=int,
+		default=0,
+		help="Index of the shard of the documents processed by this worker.",
+	)
+	parser.add_argument(
+		"--num_shards",
+		type=int,
+		default=1,
+		help="Number of workers the documents are split between.",
+	)
+	parser.add_argument(
+		"--load_workers",
+		type=int,
+		default=1,
+		help="Number of threads reading the node files ahead, only the reads run in parallel.",
+	)
+	parser.add_argument(
+		"--trusted",
+		action="store_true",
+		help="Skip the validation of the nodes, only for files written by the embedding pipeline.",
+	)
 	args = parser.parse_args()
 
 	input_path = Path(args.document_path)
 	# the output path is the same as the input path, as we are not saving any new files
 	output_path = Path(args.document_path)
-	io_manager = IOManager(input_document_path=input_path, output_path=output_path)
+	io_manager = IOManager(
+		input_document_path=input_path,
+		output_path=output_path,
+		node_format=args.node_format,
+		lazy=True,
+		shard_index=args.shard_index,
+		num_shards=args.num_shards,
+		load_workers=args.load_workers,
+		trusted=args.trusted,
+	)
 
 	assert (
 		io_manager.input_document_path.exists()
@@ -65,26 +114,28 @@ if __name__ == "__main__":
 	)
 	milvus_client = MilvusDatabase(milvus_settings=settings)
 	milvus_client.create_index_if_not_exists()
-	document_to_process = (
-		args.number_of_documents
-		if args.number_of_documents
-		else io_manager.number_of_documents
+	embedding_matrix = (
+		EmbeddingMatrix(args.embedding_matrix_path)
+		if args.embedding_matrix_path
+		else None
 	)
 	logger.info(
-		f"Processing {document_to_process} documents in chunks of size {args.chunk_size}"
+		f"Processing shard {args.shard_index + 1}/{args.num_shards} in batches of {args.batch_size} nodes"
 	)
-	for i in range(0, document_to_process, args.chunk_size):
-		logger.info(f"Processing documents from index {i} to {i + args.chunk_size}")
-		nodes = io_manager.load_nodes_document(i, i + args.chunk_size)
+	written_nodes = 0
+	for nodes in io_manager.iter_node_batches(
+		batch_size=args.batch_size, limit=args.number_of_documents
+	):
+		if embedding_matrix is not None:
+			embedding_matrix.assign_embeddings(nodes)
 		nodes_to_write = []
 		for node in nodes:
 			node_json = node.to_milvus_entity()
 			nodes_to_write.append(node_json)
 		try:
 			milvus_client.write_data(nodes_to_write)
-			logger.info(
-				f"Finished processing documents from index {i} to {i + args.chunk_size}"
-			)
+			written_nodes += len(nodes_to_write)
+			logger.info(f"Finished writing {written_nodes} nodes")
 		except Exception as e:
 			logger.error(f"Failed to insert entities into Milvus: {str(e)}")
 			raise
@@ -1,9 +1,10 @@
 # The Main script to insert the code in The postgres database
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from os import getenv
 from pathlib import Path
-
-from tqdm import trange
+from typing import List, Optional, Tuple
 
 from src.rag.components.data_ingestion.utils import (
 	create_postgres_connection,
@@ -11,6 +12,7 @@ from src.rag.components.data_ingestion.utils import (
 	extract_documents_from_nodes,
 )
 from src.rag.components.shared.databases.postgres import PostgresVectorDBClient
+from src.rag.components.shared.embedding_matrix import EmbeddingMatrix
 from src.rag.components.shared.io import IOManager
 from src.rag.schemas.document import Document, Node
 from src.shared.logger import setup_logger
@@ -21,15 +23,126 @@ DEFAULT_COLLECTION_NAME = "my_documents"
 EMBEDDING_DIMENSION = int(getenv("EMBEDDING_DIMENSION", 1024))
 
 
+def create_postgres_client(collection_name: str) -> PostgresVectorDBClient:
+	connection = create_postgres_connection(create_postgres_connection_uri())
+	return PostgresVectorDBClient(connection=connection, namespace=collection_name)
+
+
+def prepare_tables(
+	postgres_client: PostgresVectorDBClient,
+	collection_name: str,
+	full_text_language: str,
+) -> None:
+	"""Create the tables and drop the foreign key, which is added back once every worker is done."""
+	postgres_client.create_table(
+		name="documents", schema=Document.to_sql_schema(), if_not_exists=True
+	)
+	postgres_client.create_table(
+		name="nodes",
+		schema=Node.to_sql_schema(
+			embedding_dimension=EMBEDDING_DIMENSION,
+			table_prefix=collection_name,
+		),
+		if_not_exists=True,
+	)
+	# drop foreign key if it exists to speed up the insertiion process. This will be added later
+	postgres_client.drop_constraint(
+		table_name="nodes",
+		constraint_name=f"{collection_name}_nodes_document_id_foreign_key",
+	)
+	postgres_client.add_text_search_field(
+		table_name="nodes", column_name="text", language=full_text_language
+	)
+
+
+def shard_limit(
+	number_of_documents: Optional[int], shard_index: int, num_shards: int
+) -> Optional[int]:
+	"""Share of the document limit given to a shard, the shares add up to the limit."""
+	if number_of_documents is None:
+		return None
+	return number_of_documents // num_shards + (
+		shard_index < number_of_documents % num_shards
+	)
+
+
+def ingest_shard(
+	document_path: Path,
+	collection_name: str,
+	shard_index: int = 0,
+	num_shards: int = 1,
+	batch_size: int = 1000,
+	number_of_documents: Optional[int] = None,
+	embedding_matrix_path: Optional[str] = None,
+	load_workers: int = 1,
+	node_format: str = "json",
+) -> Tuple[int, int, List[str]]:
+	"""
+	COPY the nodes and documents of one shard of the files, on a connection of its own.
+
+	Returns:
+	    Tuple of (inserted nodes, inserted documents, failed documents)
+	"""
+	io_manager = IOManager(
+		input_document_path=document_path,
+		# the output path is the same as the input path, as we are not saving any new files
+		output_path=document_path,
+		node_format=node_format,
+		lazy=True,
+		shard_index=shard_index,
+		num_shards=num_shards,
+		load_workers=load_workers,
+	)
+	embedding_matrix = (
+		EmbeddingMatrix(embedding_matrix_path) if embedding_matrix_path else None
+	)
+	postgres_client = create_postgres_client(collection_name)
+	inserted_nodes = 0
+	inserted_documents = 0
+	try:
+		for nodes in io_manager.iter_node_batches(
+			batch_size=batch_size, limit=number_of_documents
+		):
+			if embedding_matrix is not None:
+				embedding_matrix.assign_embeddings(nodes)
+			nodes_sql = [node.to_sql_insert() for node in nodes]
+			documents = extract_documents_from_nodes(nodes)
+			try:
+				inserted_nodes += len(
+					postgres_client.bulk_copy(
+						table_name="nodes", data=nodes_sql, returning=["node_id"]
+					)
+				)
+				inserted_documents += len(
+					postgres_client.bulk_copy(
+						table_name="documents",
+						data=list(documents.values()),
+						returning=["doc_id"],
+					)
+				)
+				logger.info(
+					f"Shard {shard_index + 1}/{num_shards}: {inserted_nodes} nodes inserted"
+				)
+			except Exception as e:
+				logger.error(f"Failed to insert entities into postgres {str(e)}")
+				raise
+	finally:
+		postgres_client.close()
+	return inserted_nodes, inserted_documents, io_manager.failed_documents
+
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(
 		description="Process the argument to connect to the database."
 	)
 	parser.add_argument(
+		"--batch_size",
+		# deprecated alias, it counted documents and now counts nodes
 		"--chunk_size",
+		dest="batch_size",
 		type=int,
-		default=100,
-		help="Number of documents to load at a time.",
+		default=1000,
+		help="Number of nodes copied to postgres at a time, --chunk_size is a deprecated alias.",
 	)
 
 	# document path argument
@@ -51,72 +164,117 @@ if __name__ == "__main__":
 		"--number_of_documents",
 		type=int,
 		default=None,
-		help="Number of documents to process.",
+		help="Number of documents to process, split between the workers.",
 	)
-	args = parser.parse_args()
-
-	input_path = Path(args.document_path)
-	# the output path is the same as the input path, as we are not saving any new files
-	output_path = Path(args.document_path)
-	io_manager = IOManager(input_document_path=input_path, output_path=output_path)
-
-	assert (
-		io_manager.input_document_path.exists()
-	), f"Document path {io_manager.input_document_path} does not exist."
-	connection_uri = create_postgres_connection_uri()
-	connection = create_postgres_connection(connection_uri)
-	postgres_client = PostgresVectorDBClient(
-		connection=connection,
-		namespace=args.collection_name,
+	parser.add_argument(
+		"--workers",
+		type=int,
+		default=1,
+		help="Number of processes, each one copying a shard of the documents on its own connection.",
 	)
-
-	postgres_client.create_table(
-		name="documents", schema=Document.to_sql_schema(), if_not_exists=True
+	parser.add_argument(
+		"--load_workers",
+		type=int,
+		default=1,
+		help="Number of threads reading the node files ahead in each worker, only the reads run in parallel.",
 	)
-	postgres_client.create_table(
-		name="nodes",
-		schema=Node.to_sql_schema(
-			embedding_dimension=EMBEDDING_DIMENSION,
-			table_prefix=DEFAULT_COLLECTION_NAME,
-		),
-		if_not_exists=True,
+	parser.add_argument(
+		"--node_format",
+		type=str,
+		choices=["json", "parquet"],
+		default="json",
+		help="Format of the node files, the parquet embeddings are read without copy.",
 	)
-	# drop foreign key if it exists to speed up the insertiion process. This will be added later
-	postgres_client.drop_constraint(
-		table_name="nodes",
-		constraint_name=f"{DEFAULT_COLLECTION_NAME}_nodes_document_id_foreign_key",
+	parser.add_argument(
+		"--embedding_matrix_path",
+		type=str,
+		default=None,
+		help="Folder of the memory mapped embedding matrices, when the node files have no embeddings.",
+	)
+	parser.add_argument(
+		"--unlogged",
+		action="store_true",
+		help="Set the tables UNLOGGED during the load, faster but emptied if the server crashes mid-load.",
+	)
+	parser.add_argument(
+		"--maintenance_work_mem",
+		type=str,
+		default="2GB",
+		help="Memory of each index build.",
 	)
-	document_to_process = (
-		args.number_of_documents
-		if args.number_of_documents
-		else io_manager.number_of_documents
+	parser.add_argument(
+		"--max_parallel_maintenance_workers",
+		type=int,
+		default=4,
+		help="Parallel workers of each index build.",
 	)
+	parser.add_argument(
+		"--full_text_language",
+		type=str,
+		default="english",
+		help="Text search configuration of the full-text column of the nodes.",
+	)
+	args = parser.parse_args()
+
+	document_path = Path(args.document_path)
+	assert document_path.exists(), f"Document path {document_path} does not exist."
+	postgres_client = create_postgres_client(args.collection_name)
+	prepare_tables(postgres_client, args.collection_name, args.full_text_language)
+
+	shard_arguments = {
+		"document_path": document_path,
+		"collection_name": args.collection_name,
+		"num_shards": args.workers,
+		"batch_size": args.batch_size,
+		"embedding_matrix_path": args.embedding_matrix_path,
+		"load_workers": args.load_workers,
+		"node_format": args.node_format,
+	}
 	logger.info(
-		f"Processing {document_to_process} documents in chunks of size {args.chunk_size}"
+		f"Ingesting {document_path} with {args.workers} workers in batches of {args.batch_size} nodes"
 	)
-	for i in trange(
-		0, document_to_process, args.chunk_size, desc="Ingesting documents"
+	# the vector and full-text indexes are dropped during the load and rebuilt once at the end
+	with postgres_client.bulk_load(
+		table_names=["nodes", "documents"],
+		unlogged=args.unlogged,
+		maintenance_work_mem=args.maintenance_work_mem,
+		max_parallel_maintenance_workers=args.max_parallel_maintenance_workers,
 	):
-		logger.info(f"Processing documents from index {i} to {i + args.chunk_size}")
-		nodes = io_manager.load_nodes_document(i, i + args.chunk_size)
-		nodes_sql = [doc.to_sql_insert(DEFAULT_COLLECTION_NAME) for doc in nodes]
-		documents = extract_documents_from_nodes(nodes)
-		try:
-			inserted_nodes = postgres_client.bulk_insert(
-				table_name="nodes", data=nodes_sql, returning=["node_id"]
-			)
-			inserted_documents = postgres_client.bulk_insert(
-				table_name="documents",
-				data=list(documents.values()),
-				returning=["doc_id"],
-			)
-
-			logger.info(
-				f"Finished processing documents from index {i} to {i + args.chunk_size}"
-			)
-		except Exception as e:
-			logger.error(f"Failed to insert entities into postgres {str(e)}")
-			raise
+		if args.workers > 1:
+			with ProcessPoolExecutor(
+				max_workers=args.workers,
+				mp_context=multiprocessing.get_context("spawn"),
+			) as executor:
+				futures = [
+					executor.submit(
+						ingest_shard,
+						shard_index=index,
+						number_of_documents=shard_limit(
+							args.number_of_documents, index, args.workers
+						),
+						**shard_arguments,
+					)
+					for index in range(args.workers)
+				]
+				results = [future.result() for future in futures]
+		else:
+			results = [
+				ingest_shard(
+					shard_index=0,
+					number_of_documents=args.number_of_documents,
+					**shard_arguments,
+				)
+			]
+
+	inserted_nodes = sum(result[0] for result in results)
+	inserted_documents = sum(result[1] for result in results)
+	failed_documents = [path for result in results for path in result[2]]
+	logger.info(
+		f"Inserted {inserted_nodes} nodes and {inserted_documents} documents, "
+		f"{len(failed_documents)} files failed to load"
+	)
+
+	# coordination step, run once after every worker is done
 	postgres_client.add_foreign_key_to_table(
 		table_name="nodes",
 		column_name="document_id",
@@ -125,10 +283,17 @@ if __name__ == "__main__":
 		if_not_exists=False,
 	)
 
-	postgres_client.create_index(
-		table_name="nodes",
-		column_name="embedding",
-		index_config="USING vchordrq",
-		if_not_exists=True,
-	)
+	# the first load has no index to rebuild, they are created here with the same settings
+	with postgres_client.maintenance_settings(
+		maintenance_work_mem=args.maintenance_work_mem,
+		max_parallel_maintenance_workers=args.max_parallel_maintenance_workers,
+	):
+		postgres_client.create_embedding_index(
+			table_name="nodes",
+			column_name="embedding",
+			index_config="USING vchordrq",
+			if_not_exists=True,
+		)
+		postgres_client.create_full_text_index(table_name="nodes", column_name="text")
+	postgres_client.close()
 	logger.info("Finished processing all documents.")
@@ -0,0 +1,197 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+
+from src.shared.logger import setup_logger
+from src.shared.text import normalize_text
+
+logger = setup_logger("embedding cache")
+
+
+class EmbeddingStore(ABC):
+	"""Second tier storage for the embedding cache, shared across processes or restarts."""
+
+	@abstractmethod
+	def get(self, key: str) -> Optional[np.ndarray]:
+		"""
+		Return the embedding stored under the key, or None if it is missing.
+
+		Args:
+		    key (str): The cache key.
+		"""
+		pass
+
+	@abstractmethod
+	def set(self, key: str, embedding: np.ndarray) -> None:
+		"""
+		Store an embedding under the key.
+
+		Args:
+		    key (str): The cache key.
+		    embedding (np.ndarray): The float32 embedding to store.
+		"""
+		pass
+
+	def close(self) -> None:
+		"""Release the resources held by the store."""
+		pass
+
+
+class SQLiteEmbeddingStore(EmbeddingStore):
+	"""Local disk backed store keeping the embeddings as float32 blobs in a SQLite file."""
+
+	def __init__(self, database_path: Union[Path, str]):
+		self.database_path = Path(database_path)
+		self.database_path.parent.mkdir(parents=True, exist_ok=True)
+		self._lock = threading.Lock()
+		self.connection = sqlite3.connect(
+			str(self.database_path), check_same_thread=False
+		)
+		with self._lock, self.connection:
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute(
+				"CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+			)
+		logger.info(f"SQLite embedding store opened at {self.database_path}")
+
+	def get(self, key: str) -> Optional[np.ndarray]:
+		with self._lock:
+			row = self.connection.execute(
+				"SELECT embedding FROM embeddings WHERE key = ?", (key,)
+			).fetchone()
+		if row is None:
+			return None
+		return np.frombuffer(row[0], dtype=np.float32)
+
+	def set(self, key: str, embedding: np.ndarray) -> None:
+		blob = np.asarray(embedding, dtype=np.float32).tobytes()
+		with self._lock, self.connection:
+			self.connection.execute(
+				"INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+				(key, blob),
+			)
+
+	def close(self) -> None:
+		self.connection.close()
+
+
+class EmbeddingCache:
+	"""
+	Thread safe in-process LRU cache of embeddings with a time to live.
+
+	Entries are evicted in least recently used order once `max_entries` or
+	`max_size_mb` is exceeded. Misses fall through to the optional second tier,
+	and entries found there are promoted back into memory.
+	"""
+
+	def __init__(
+		self,
+		max_entries: int = 10_000,
+		ttl_seconds: Optional[float] = 3600,
+		max_size_mb: Optional[float] = None,
+		second_tier: Optional[EmbeddingStore] = None,
+	):
+		"""
+		Args:
+		    max_entries: Maximum number of embeddings kept in memory
+		    ttl_seconds: Time after which an in-memory entry expires, None to never expire
+		    max_size_mb: Optional cap on the memory used by the cached embeddings
+		    second_tier: Optional store consulted on in-memory misses
+		"""
+		self.max_entries = max_entries
+		self.ttl_seconds = ttl_seconds
+		self.max_size_bytes = max_size_mb * 1024 * 1024 if max_size_mb else None
+		self.second_tier = second_tier
+		self._entries: OrderedDict[str, Tuple[float, np.ndarray]] = OrderedDict()
+		self._size_bytes = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.second_tier_hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def make_key(model_name: str, text: str, prefix: str = "") -> str:
+		"""Build the cache key from the model name, the normalized text and the prefix."""
+		raw_key = "\x1f".join([model_name, prefix, normalize_text(text)])
+		return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+	def get(self, key: str) -> Optional[np.ndarray]:
+		"""Return the cached embedding for the key, or None on a miss."""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				inserted_at, embedding = entry
+				if self._is_expired(inserted_at):
+					self._remove(key)
+				else:
+					self._entries.move_to_end(key)
+					self.hits += 1
+					return embedding
+		if self.second_tier is not None:
+			embedding = self.second_tier.get(key)
+			if embedding is not None:
+				with self._lock:
+					self.second_tier_hits += 1
+					self._put(key, embedding)
+				return embedding
+		with self._lock:
+			self.misses += 1
+		return None
+
+	def set(self, key: str, embedding: np.ndarray) -> None:
+		"""Cache the embedding in memory and in the second tier."""
+		embedding = np.asarray(embedding, dtype=np.float32)
+		with self._lock:
+			self._put(key, embedding)
+		if self.second_tier is not None:
+			self.second_tier.set(key, embedding)
+
+	def clear(self) -> None:
+		"""Drop every in-memory entry, the second tier is left untouched."""
+		with self._lock:
+			self._entries.clear()
+			self._size_bytes = 0
+
+	@property
+	def stats(self) -> Dict[str, float]:
+		"""Hit and miss counters along with the current memory footprint."""
+		with self._lock:
+			lookups = self.hits + self.second_tier_hits + self.misses
+			return {
+				"hits": self.hits,
+				"second_tier_hits": self.second_tier_hits,
+				"misses": self.misses,
+				"hit_ratio": (self.hits + self.second_tier_hits) / lookups
+				if lookups
+				else 0.0,
+				"entries": len(self._entries),
+				"size_mb": self._size_bytes / (1024 * 1024),
+			}
+
+	def _is_expired(self, inserted_at: float) -> bool:
+		if self.ttl_seconds is None:
+			return False
+		return time.monotonic() - inserted_at > self.ttl_seconds
+
+	def _put(self, key: str, embedding: np.ndarray) -> None:
+		if key in self._entries:
+			self._remove(key)
+		self._entries[key] = (time.monotonic(), embedding)
+		self._size_bytes += embedding.nbytes
+		while self._entries and (
+			len(self._entries) > self.max_entries
+			or (self.max_size_bytes and self._size_bytes > self.max_size_bytes)
+		):
+			_, (_, evicted) = self._entries.popitem(last=False)
+			self._size_bytes -= evicted.nbytes
+
+	def _remove(self, key: str) -> None:
+		_, embedding = self._entries.pop(key)
+		self._size_bytes -= embedding.nbytes
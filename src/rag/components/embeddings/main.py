@@ -1,8 +1,18 @@
 import argparse
+import shutil
 import time
+from itertools import islice
 from pathlib import Path
+from typing import Optional
 
 from src.rag.components.embeddings.embeddings import EmbeddingComputer
+from src.rag.components.embeddings.manifest import RunManifest
+from src.rag.components.embeddings.pipeline import EmbeddingPipeline
+from src.rag.components.embeddings.pool import (
+	EMBEDDING_MATRIX_FOLDER,
+	EmbeddingWorkerPool,
+)
+from src.rag.components.shared.embedding_matrix import EmbeddingMatrixWriter
 from src.rag.components.shared.io import IOManager
 from src.shared.logger import setup_logger
 
@@ -15,37 +25,89 @@ def main(
 	output_path: str,
 	batch_size: int,
 	limit: int,
+	max_batch_tokens: int,
+	loader_workers: int,
+	workers: int = 1,
+	force: bool = False,
+	node_format: str = "json",
+	embedding_matrix_dtype: Optional[str] = None,
+	shard_index: int = 0,
+	num_shards: int = 1,
 ):
 	input_path = Path(input_path)
 	input_path = Path.cwd().joinpath("datasets", input_path)
 	output_path = Path(output_path)
 
 	output_path.mkdir(parents=True, exist_ok=True)
-	io_manager = IOManager(input_document_path=input_path, output_path=output_path)
-	embedding_computer = EmbeddingComputer(model_name=embedding_model_name)
+	manifest_path = output_path.joinpath("embedding_manifest.sqlite")
+	embedding_matrix_path = output_path.joinpath(EMBEDDING_MATRIX_FOLDER)
+	if force:
+		manifest_path.unlink(missing_ok=True)
+		shutil.rmtree(embedding_matrix_path, ignore_errors=True)
+	embedding_computer = None
+	embedding_matrix = None
+	if workers <= 1:
+		embedding_computer = EmbeddingComputer(model_name=embedding_model_name)
+		if embedding_matrix_dtype:
+			embedding_matrix = EmbeddingMatrixWriter(
+				embedding_matrix_path,
+				embedding_computer.vector_dimension,
+				dtype=embedding_matrix_dtype,
+			)
+	io_manager = IOManager(
+		input_document_path=input_path,
+		output_path=output_path,
+		# the inputs are the JSON files of the parser, the format applies to the outputs
+		glob="**/*.json",
+		node_format=node_format,
+		embedding_matrix=embedding_matrix,
+		lazy=True,
+		shard_index=shard_index,
+		num_shards=num_shards,
+	)
 	# save the starttime here
 	start_time = time.time()
 	logger.info(f"Start time: {start_time}")
-	if limit:
-		doc_to_process = io_manager.all_documents[:limit]
-	else:
-		doc_to_process = io_manager.all_documents
+	# the documents are listed while the pipeline consumes them
+	doc_to_process = islice(io_manager.iter_documents(), limit)
 	logger.info(
-		f"Number of documents to process: {len(doc_to_process)} from {input_path}"
+		f"Processing shard {shard_index + 1}/{num_shards} of the documents from {input_path}"
 	)
-	for i in range(0, len(doc_to_process), batch_size):
-		logger.info(f"Processing documents from index {i} to {i + batch_size}")
-		nodes = io_manager.load_nodes_document(i, i + batch_size)
-		nodes = embedding_computer.compute_embeddings_in_batch(
-			nodes, batch_size=batch_size
+	if workers > 1:
+		pool = EmbeddingWorkerPool(
+			embedding_model_name=embedding_model_name,
+			input_path=input_path,
+			output_path=output_path,
+			workers=workers,
+			max_batch_tokens=max_batch_tokens,
+			max_batch_size=batch_size,
+			loader_workers=loader_workers,
+			manifest_path=manifest_path,
+			node_format=node_format,
+			embedding_matrix_dtype=embedding_matrix_dtype,
+		)
+		try:
+			# the pool splits the documents between the workers, so it needs the full list
+			pool.run(list(doc_to_process))
+		finally:
+			io_manager.failed_documents.extend(pool.failed_documents)
+	else:
+		pipeline = EmbeddingPipeline(
+			io_manager=io_manager,
+			embedding_computer=embedding_computer,
+			max_batch_tokens=max_batch_tokens,
+			max_batch_size=batch_size,
+			loader_workers=loader_workers,
+			manifest=RunManifest(manifest_path, embedding_model_name),
 		)
-		io_manager.save_parsed_nodes(nodes)
-		logger.info(f"Finished processing documents from index {i} to {i + batch_size}")
+		try:
+			pipeline.run(doc_to_process)
+		finally:
+			if embedding_matrix is not None:
+				embedding_matrix.close()
 	end_time = time.time()
 	elapsed_time = (end_time - start_time) / 60
-	logger.info(
-		f"Total time taken to compute embedding for {io_manager.number_of_documents} is : {elapsed_time} minutes"
-	)
+	logger.info(f"Total time taken to compute the embeddings: {elapsed_time} minutes")
 	io_manager.write_object_to_file(
 		output_path.joinpath("failed_document_list.txt"), io_manager.failed_documents
 	)
@@ -80,7 +142,54 @@ if __name__ == "__main__":
 		"--batch_size",
 		type=int,
 		default=50,
-		help="Batch size for computing embeddings.",
+		help="Maximum number of nodes encoded in one forward pass.",
+	)
+	parser.add_argument(
+		"--max_batch_tokens",
+		type=int,
+		default=16_384,
+		help="Maximum number of padded tokens encoded in one forward pass.",
+	)
+	parser.add_argument(
+		"--loader_workers",
+		type=int,
+		default=4,
+		help="Number of threads parsing the input files ahead of the encoder.",
+	)
+	parser.add_argument(
+		"--workers",
+		type=int,
+		default=1,
+		help="Number of processes, each one running its own model replica on a shard of the documents.",
+	)
+	parser.add_argument(
+		"--force",
+		action="store_true",
+		help="Embed every document again instead of skipping the ones recorded in the run manifest.",
+	)
+	parser.add_argument(
+		"--node_format",
+		choices=["json", "parquet"],
+		default="json",
+		help="Format of the saved nodes, parquet keeps the embeddings as float32 columns.",
+	)
+	parser.add_argument(
+		"--embedding_matrix_dtype",
+		choices=["float32", "float16"],
+		default=None,
+		help="Save the embeddings in memory mapped .npy matrices instead of the node files.",
+	)
+	parser.add_argument(
+		"--shard_index",
+		type=int,
+		default=0,
+		help="Index of the shard of the documents processed by this run.",
+	)
+	parser.add_argument(
+		"--num_shards",
+		type=int,
+		default=1,
+		help="Number of runs the documents are split between, e.g. one per machine.",
 	)
 	parser.add_argument(
 		"--limit",
@@ -96,4 +205,12 @@ if __name__ == "__main__":
 		output_path=args.output_path,
 		batch_size=args.batch_size,
 		limit=args.limit,
+		max_batch_tokens=args.max_batch_tokens,
+		loader_workers=args.loader_workers,
+		workers=args.workers,
+		force=args.force,
+		node_format=args.node_format,
+		embedding_matrix_dtype=args.embedding_matrix_dtype,
+		shard_index=args.shard_index,
+		num_shards=args.num_shards,
 	)
@@ -0,0 +1,135 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from src.shared.logger import setup_logger
+
+logger = setup_logger("embedding manifest")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_content_hash(path: Path) -> str:
+	"""sha256 of the content of a file, read in chunks."""
+	digest = hashlib.sha256()
+	with open(path, "rb") as file:
+		for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+class RunManifest:
+	"""
+	SQLite record of the input files already embedded, keyed by content hash and model name.
+
+	A restarted run skips the completed inputs, and a modified input gets a new
+	content hash, so only the delta is embedded again. The output name of an input
+	is derived from its content hash and the model, so reruns overwrite their own
+	files instead of adding duplicates. The file is safe to share between the
+	worker processes of a run.
+	"""
+
+	def __init__(self, database_path: Union[Path, str], model_name: str):
+		"""
+		Args:
+		    database_path: Path of the SQLite file, created if missing
+		    model_name: Name of the embedding model of the run
+		"""
+		self.database_path = Path(database_path)
+		self.database_path.parent.mkdir(parents=True, exist_ok=True)
+		self.model_name = model_name
+		self._lock = threading.Lock()
+		# the hashes of the files seen by this process, invalidated on size or mtime change
+		self._hashes: Dict[str, Tuple[int, int, str]] = {}
+		self.connection = sqlite3.connect(
+			str(self.database_path), check_same_thread=False, timeout=60
+		)
+		with self._lock, self.connection:
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute(
+				"CREATE TABLE IF NOT EXISTS embedded_files ("
+				"content_hash TEXT NOT NULL, model_name TEXT NOT NULL, "
+				"input_path TEXT NOT NULL, output_path TEXT NOT NULL, "
+				"nodes INTEGER NOT NULL, completed_at REAL NOT NULL, "
+				"PRIMARY KEY (content_hash, model_name))"
+			)
+		logger.info(f"Run manifest opened at {self.database_path}")
+
+	def content_hash(self, input_path: Path) -> str:
+		"""Content hash of the input file, hashed again only when its size or mtime changed."""
+		stat = Path(input_path).stat()
+		cached = self._hashes.get(str(input_path))
+		if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+			return cached[2]
+		content_hash = file_content_hash(input_path)
+		self._hashes[str(input_path)] = (stat.st_size, stat.st_mtime_ns, content_hash)
+		return content_hash
+
+	def output_id(self, input_path: Path) -> str:
+		"""Deterministic identifier of the output file of an input for the model of the run."""
+		raw_id = "\x1f".join([self.content_hash(input_path), self.model_name])
+		return hashlib.sha256(raw_id.encode("utf-8")).hexdigest()[:16]
+
+	def is_completed(self, input_path: Path) -> bool:
+		"""Whether the current content of the input was already embedded with the model."""
+		content_hash = self.content_hash(input_path)
+		with self._lock:
+			row = self.connection.execute(
+				"SELECT 1 FROM embedded_files WHERE content_hash = ? AND model_name = ?",
+				(content_hash, self.model_name),
+			).fetchone()
+		return row is not None
+
+	def mark_completed(
+		self, input_path: Path, output_path: Optional[Path], nodes: int
+	) -> None:
+		"""
+		Record the input as embedded.
+
+		The outputs of the previous versions of the same input are deleted, so a
+		modified input does not leave stale nodes behind. An input without nodes
+		has no output, its `output_path` is None.
+		"""
+		content_hash = self.content_hash(input_path)
+		with self._lock, self.connection:
+			stale_rows = self.connection.execute(
+				"SELECT content_hash, output_path FROM embedded_files "
+				"WHERE input_path = ? AND model_name = ? AND content_hash != ?",
+				(str(input_path), self.model_name, content_hash),
+			).fetchall()
+			for stale_hash, stale_output in stale_rows:
+				if stale_output:
+					Path(stale_output).unlink(missing_ok=True)
+				self.connection.execute(
+					"DELETE FROM embedded_files WHERE content_hash = ? AND model_name = ?",
+					(stale_hash, self.model_name),
+				)
+			self.connection.execute(
+				"INSERT OR REPLACE INTO embedded_files "
+				"(content_hash, model_name, input_path, output_path, nodes, completed_at) "
+				"VALUES (?, ?, ?, ?, ?, ?)",
+				(
+					content_hash,
+					self.model_name,
+					str(input_path),
+					# the column is not nullable, an input without output is stored as ""
+					str(output_path) if output_path is not None else "",
+					nodes,
+					time.time(),
+				),
+			)
+
+	def completed_count(self) -> int:
+		"""Number of inputs embedded with the model of the run."""
+		with self._lock:
+			(count,) = self.connection.execute(
+				"SELECT COUNT(*) FROM embedded_files WHERE model_name = ?",
+				(self.model_name,),
+			).fetchone()
+		return count
+
+	def close(self) -> None:
+		self.connection.close()
@@ -0,0 +1,362 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from src.rag.components.embeddings.cache import EmbeddingCache
+from src.rag.components.embeddings.embeddings import (
+	PASSAGE_PREFIX,
+	EmbeddingComputer,
+	pack_by_token_budget,
+)
+from src.rag.components.embeddings.manifest import RunManifest
+from src.rag.components.shared.io import IOManager
+from src.rag.schemas.document import Node
+from src.shared.logger import setup_logger
+
+logger = setup_logger("embedding pipeline")
+
+# marks the end of a stream in the queues
+END_OF_STREAM = object()
+
+
+@dataclass
+class PipelineStats:
+	"""Counters of an embedding run."""
+
+	documents: int = 0
+	skipped_documents: int = 0
+	nodes: int = 0
+	duplicate_nodes: int = 0
+	batches: int = 0
+	tokens: int = 0
+	padded_tokens: int = 0
+	duplicate_tokens: int = 0
+	encoding_seconds: float = 0.0
+	elapsed_seconds: float = 0.0
+	errors: List[str] = field(default_factory=list)
+
+	@property
+	def nodes_per_second(self) -> float:
+		return self.nodes / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+	@property
+	def padding_efficiency(self) -> float:
+		"""Share of the computed tokens that are real tokens and not padding."""
+		return self.tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+	@property
+	def deduplication_savings(self) -> float:
+		"""Share of the tokens of the run that were not encoded because their text was already seen."""
+		total_tokens = self.tokens + self.duplicate_tokens
+		return self.duplicate_tokens / total_tokens if total_tokens else 0.0
+
+	@property
+	def model_utilization(self) -> float:
+		"""Share of the run spent inside the model."""
+		return (
+			self.encoding_seconds / self.elapsed_seconds
+			if self.elapsed_seconds
+			else 0.0
+		)
+
+	def merge(self, other: "PipelineStats") -> None:
+		"""Add the counters of another run, the elapsed time is left to the caller."""
+		self.documents += other.documents
+		self.skipped_documents += other.skipped_documents
+		self.nodes += other.nodes
+		self.duplicate_nodes += other.duplicate_nodes
+		self.batches += other.batches
+		self.tokens += other.tokens
+		self.padded_tokens += other.padded_tokens
+		self.duplicate_tokens += other.duplicate_tokens
+		self.encoding_seconds += other.encoding_seconds
+		self.errors.extend(other.errors)
+
+
+@dataclass
+class _PendingDocument:
+	"""Nodes of one input file, written once all of them have an embedding."""
+
+	path: Path
+	nodes: List[Node]
+	remaining: int
+
+
+class EmbeddingPipeline:
+	"""
+	Producer / consumer pipeline computing the embeddings of the parsed documents.
+
+	Loader threads parse the input files ahead of the encoder, the encoder
+	gathers a look-ahead window of nodes from consecutive files, sorts it by
+	length and packs it into batches bounded by a token budget, and a writer
+	thread saves each file as soon as all its nodes are embedded.
+	Nodes whose normalized text was already encoded during the run, such as
+	repeated headers or disclaimers, reuse that embedding instead of going
+	through the model again.
+	The queues between the stages are bounded, so a slow stage applies
+	backpressure to the stages before it instead of buffering the corpus.
+	"""
+
+	def __init__(
+		self,
+		io_manager: IOManager,
+		embedding_computer: EmbeddingComputer,
+		max_batch_tokens: int = 16_384,
+		max_batch_size: int = 64,
+		loader_workers: int = 4,
+		queue_size: int = 16,
+		manifest: Optional[RunManifest] = None,
+		deduplication_cache_size: int = 50_000,
+		packing_window: int = 512,
+	):
+		"""
+		Args:
+		    io_manager: Loads the input files and saves the nodes with embeddings
+		    embedding_computer: Computes the embeddings
+		    max_batch_tokens: Maximum padded tokens (longest node x number of nodes) per forward pass
+		    max_batch_size: Maximum number of nodes per forward pass
+		    loader_workers: Number of threads parsing the input files
+		    queue_size: Capacity of the queues between the stages
+		    manifest: Optional record of the embedded inputs, the completed ones are skipped
+		    deduplication_cache_size: Number of distinct texts whose embedding is kept for reuse, 0 to disable
+		    packing_window: Number of nodes sorted by length together before being packed into batches
+		"""
+		self.io_manager = io_manager
+		self.embedding_computer = embedding_computer
+		self.max_batch_tokens = max_batch_tokens
+		self.max_batch_size = max_batch_size
+		self.loader_workers = loader_workers
+		self.queue_size = queue_size
+		self.manifest = manifest
+		self.deduplication_cache_size = deduplication_cache_size
+		self.packing_window = max(packing_window, max_batch_size)
+		self.stats = PipelineStats()
+
+	def run(self, documents: Iterable[Path]) -> PipelineStats:
+		"""Embed every node of the documents and save them, returning the run statistics."""
+		self.stats = PipelineStats()
+		start_time = time.perf_counter()
+		path_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+		loaded_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+		write_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+
+		feeder = threading.Thread(
+			target=self._feed, args=(documents, path_queue), name="embedding-feeder"
+		)
+		loaders = [
+			threading.Thread(
+				target=self._load,
+				args=(path_queue, loaded_queue),
+				name=f"embedding-loader-{index}",
+			)
+			for index in range(self.loader_workers)
+		]
+		writer = threading.Thread(
+			target=self._write, args=(write_queue,), name="embedding-writer"
+		)
+		for thread in [feeder, *loaders, writer]:
+			thread.daemon = True
+			thread.start()
+
+		try:
+			self._encode(loaded_queue, write_queue)
+		except Exception as e:
+			# such as a CUDA out of memory, the parent process of a pool reads the stats
+			self.stats.errors.append(f"encoder: {str(e)}")
+			raise
+		finally:
+			# save what was already embedded even when the encoder failed
+			write_queue.put(END_OF_STREAM)
+			writer.join()
+		# the loaders are done once the encoder consumed all their end markers
+		feeder.join()
+		for loader in loaders:
+			loader.join()
+
+		self.stats.elapsed_seconds = time.perf_counter() - start_time
+		logger.info(
+			f"Embedded {self.stats.nodes} nodes from {self.stats.documents} documents "
+			f"({self.stats.skipped_documents} already embedded) in "
+			f"{self.stats.elapsed_seconds:.1f} s ({self.stats.nodes_per_second:.1f} nodes/s, "
+			f"model busy {self.stats.model_utilization:.0%} of the time, "
+			f"padding efficiency {self.stats.padding_efficiency:.0%}, "
+			f"{self.stats.duplicate_nodes} duplicate nodes saved "
+			f"{self.stats.deduplication_savings:.0%} of the tokens)"
+		)
+		if self.stats.errors:
+			raise RuntimeError(
+				f"The embedding pipeline failed: {'; '.join(self.stats.errors)}"
+			)
+		return self.stats
+
+	def _feed(self, documents: Iterable[Path], path_queue: queue.Queue) -> None:
+		try:
+			for document_path in documents:
+				if self.manifest is not None and self.manifest.is_completed(
+					document_path
+				):
+					self.stats.skipped_documents += 1
+					continue
+				path_queue.put(document_path)
+		finally:
+			for _ in range(self.loader_workers):
+				path_queue.put(END_OF_STREAM)
+
+	def _load(self, path_queue: queue.Queue, loaded_queue: queue.Queue) -> None:
+		try:
+			while True:
+				document_path = path_queue.get()
+				if document_path is END_OF_STREAM:
+					break
+				# failures are recorded in io_manager.failed_documents
+				nodes = self.io_manager.load_nodes_from_path(document_path)
+				if nodes:
+					loaded_queue.put((document_path, nodes))
+				elif nodes is not None and not self._failed(document_path):
+					# an input without nodes has nothing to embed or save, it is completed
+					self.stats.documents += 1
+					if self.manifest is not None:
+						self.manifest.mark_completed(document_path, None, 0)
+		except Exception as e:
+			self.stats.errors.append(f"loader: {str(e)}")
+		finally:
+			loaded_queue.put(END_OF_STREAM)
+
+	def _failed(self, document_path: Path) -> bool:
+		return str(document_path) in self.io_manager.failed_documents
+
+	def _write(self, write_queue: queue.Queue) -> None:
+		while True:
+			pending = write_queue.get()
+			if pending is END_OF_STREAM:
+				break
+			try:
+				if self.manifest is None:
+					self.io_manager.save_parsed_nodes(pending.nodes)
+					continue
+				output_file = self.io_manager.save_parsed_nodes(
+					pending.nodes, file_id=self.manifest.output_id(pending.path)
+				)
+				self.manifest.mark_completed(
+					pending.path, output_file, len(pending.nodes)
+				)
+			except Exception as e:
+				logger.error(f"Failed to save the nodes of {pending.path}: {str(e)}")
+				self.stats.errors.append(f"writer: {str(e)}")
+
+	def _encode(self, loaded_queue: queue.Queue, write_queue: queue.Queue) -> None:
+		finished_loaders = 0
+		window: List[Node] = []
+		window_tokens: List[int] = []
+		owners: Dict[int, _PendingDocument] = {}
+		# nodes waiting for the embedding of an identical text already in the window
+		followers: Dict[str, List[Node]] = {}
+		known_embeddings = EmbeddingCache(
+			max_entries=self.deduplication_cache_size, ttl_seconds=None
+		)
+		while finished_loaders < self.loader_workers:
+			item = loaded_queue.get()
+			if item is END_OF_STREAM:
+				finished_loaders += 1
+				continue
+			document_path, nodes = item
+			pending = _PendingDocument(
+				path=document_path, nodes=nodes, remaining=len(nodes)
+			)
+			self.stats.documents += 1
+			token_counts = self.embedding_computer.count_tokens(
+				[f"{PASSAGE_PREFIX}{node.text}" for node in nodes]
+			)
+			for node, token_count in zip(nodes, token_counts):
+				owners[id(node)] = pending
+				key = self._deduplication_key(node)
+				if key is not None:
+					if key in followers:
+						self._count_duplicate(token_count)
+						followers[key].append(node)
+						continue
+					embedding = known_embeddings.get(key)
+					if embedding is not None:
+						self._count_duplicate(token_count)
+						node.embedding = embedding.tolist()
+						self._complete(node, owners, write_queue)
+						continue
+				window.append(node)
+				window_tokens.append(token_count)
+				if key is not None:
+					followers[key] = []
+				if len(window) >= self.packing_window:
+					self._encode_window(
+						window,
+						window_tokens,
+						owners,
+						followers,
+						known_embeddings,
+						write_queue,
+					)
+					window, window_tokens = [], []
+		if window:
+			self._encode_window(
+				window, window_tokens, owners, followers, known_embeddings, write_queue
+			)
+
+	def _deduplication_key(self, node: Node) -> Optional[str]:
+		if self.deduplication_cache_size <= 0:
+			return None
+		return EmbeddingCache.make_key(
+			self.embedding_computer.model_name, node.text, PASSAGE_PREFIX
+		)
+
+	def _count_duplicate(self, token_count: int) -> None:
+		self.stats.nodes += 1
+		self.stats.duplicate_nodes += 1
+		self.stats.duplicate_tokens += token_count
+
+	def _encode_window(
+		self,
+		window: List[Node],
+		window_tokens: List[int],
+		owners: Dict[int, _PendingDocument],
+		followers: Dict[str, List[Node]],
+		known_embeddings: EmbeddingCache,
+		write_queue: queue.Queue,
+	) -> None:
+		"""Encode the window in batches of nodes of similar length, then complete the nodes in arrival order."""
+		for indices in pack_by_token_budget(
+			window_tokens, self.max_batch_tokens, self.max_batch_size
+		):
+			self._encode_batch(
+				[window[index] for index in indices],
+				[window_tokens[index] for index in indices],
+			)
+		for node in window:
+			key = self._deduplication_key(node)
+			if key is not None:
+				known_embeddings.set(key, node.embedding)
+				for follower in followers.pop(key, []):
+					follower.embedding = list(node.embedding)
+					self._complete(follower, owners, write_queue)
+			self._complete(node, owners, write_queue)
+
+	def _encode_batch(self, batch: List[Node], batch_tokens: List[int]) -> None:
+		start_time = time.perf_counter()
+		self.embedding_computer.encode_nodes(batch)
+		self.stats.encoding_seconds += time.perf_counter() - start_time
+		self.stats.batches += 1
+		self.stats.nodes += len(batch)
+		self.stats.tokens += sum(batch_tokens)
+		self.stats.padded_tokens += max(batch_tokens) * len(batch)
+
+	def _complete(
+		self,
+		node: Node,
+		owners: Dict[int, _PendingDocument],
+		write_queue: queue.Queue,
+	) -> None:
+		pending: Optional[_PendingDocument] = owners.pop(id(node))
+		pending.remaining -= 1
+		if pending.remaining == 0:
+			write_queue.put(pending)
@@ -0,0 +1,212 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from src.rag.components.embeddings.manifest import RunManifest
+from src.rag.components.embeddings.pipeline import EmbeddingPipeline, PipelineStats
+from src.rag.components.shared.embedding_matrix import EmbeddingMatrixWriter
+from src.shared.logger import setup_logger
+
+logger = setup_logger("embedding pool")
+
+EMBEDDING_MATRIX_FOLDER = "embeddings"
+
+# each worker process holds its own model replica and pipeline
+_worker_pipeline: Optional[EmbeddingPipeline] = None
+_worker_embedding_matrix_dtype: Optional[str] = None
+
+
+def shard_documents(documents: Sequence[Path], num_shards: int) -> List[List[Path]]:
+	"""Split the documents round robin, so every shard gets a similar mix of file sizes."""
+	shards = [list(documents[index::num_shards]) for index in range(num_shards)]
+	return [shard for shard in shards if shard]
+
+
+def _init_worker(
+	embedding_model_name: str,
+	input_path: Path,
+	output_path: Path,
+	threads_per_worker: int,
+	max_batch_tokens: int,
+	max_batch_size: int,
+	loader_workers: int,
+	manifest_path: Optional[Path],
+	node_format: str,
+	embedding_matrix_dtype: Optional[str],
+) -> None:
+	# imported here so the thread settings apply before the model is loaded
+	import torch
+
+	from src.rag.components.embeddings.embeddings import EmbeddingComputer
+	from src.rag.components.shared.io import IOManager
+
+	global _worker_pipeline, _worker_embedding_matrix_dtype
+	os.environ["TOKENIZERS_PARALLELISM"] = "false"
+	torch.set_num_threads(threads_per_worker)
+	torch.set_num_interop_threads(1)
+	embedding_computer = EmbeddingComputer(model_name=embedding_model_name)
+	_worker_embedding_matrix_dtype = embedding_matrix_dtype
+	_worker_pipeline = EmbeddingPipeline(
+		io_manager=IOManager(
+			input_document_path=input_path,
+			output_path=output_path,
+			node_format=node_format,
+			# the worker receives its files, it never lists the input folder
+			lazy=True,
+		),
+		embedding_computer=embedding_computer,
+		max_batch_tokens=max_batch_tokens,
+		max_batch_size=max_batch_size,
+		loader_workers=loader_workers,
+		manifest=RunManifest(manifest_path, embedding_model_name)
+		if manifest_path
+		else None,
+	)
+	logger.info(
+		f"Embedding worker {os.getpid()} ready with {threads_per_worker} threads"
+	)
+
+
+def _embed_shard(shard: List[Path], part_name: str) -> Tuple[PipelineStats, List[str]]:
+	io_manager = _worker_pipeline.io_manager
+	io_manager.failed_documents = []
+	if _worker_embedding_matrix_dtype:
+		# one matrix part per shard, closed with the shard so no part is left half written
+		io_manager.embedding_matrix = EmbeddingMatrixWriter(
+			io_manager.output_document_path.joinpath(EMBEDDING_MATRIX_FOLDER),
+			_worker_pipeline.embedding_computer.vector_dimension,
+			part_name=part_name,
+			dtype=_worker_embedding_matrix_dtype,
+		)
+	try:
+		# a failure is raised again by future.result() in the parent process
+		_worker_pipeline.run(shard)
+	finally:
+		if io_manager.embedding_matrix is not None:
+			io_manager.embedding_matrix.close()
+			io_manager.embedding_matrix = None
+	return _worker_pipeline.stats, [str(path) for path in io_manager.failed_documents]
+
+
+class EmbeddingWorkerPool:
+	"""
+	Embed the corpus with one model replica per worker process.
+
+	The documents are split into round robin shards handed out to the workers
+	as they become free, and every worker runs its own `EmbeddingPipeline` on
+	the shards it receives. The CPU cores are divided between the replicas, so
+	N replicas do not oversubscribe the machine with N x cores threads.
+	"""
+
+	def __init__(
+		self,
+		embedding_model_name: str,
+		input_path: Path,
+		output_path: Path,
+		workers: int,
+		threads_per_worker: Optional[int] = None,
+		shards_per_worker: int = 4,
+		max_batch_tokens: int = 16_384,
+		max_batch_size: int = 64,
+		loader_workers: int = 2,
+		manifest_path: Optional[Path] = None,
+		node_format: str = "json",
+		embedding_matrix_dtype: Optional[str] = None,
+	):
+		"""
+		Args:
+		    embedding_model_name: Name of the embedding model loaded by every worker
+		    input_path: Folder of the parsed documents
+		    output_path: Folder receiving the documents with embeddings
+		    workers: Number of worker processes, each one loading a model replica
+		    threads_per_worker: Torch threads per replica, defaults to the cores divided by the workers
+		    shards_per_worker: Number of shards per worker, more shards balance the load better
+		    max_batch_tokens: Maximum padded tokens per forward pass
+		    max_batch_size: Maximum number of nodes per forward pass
+		    loader_workers: Number of threads parsing the input files in each worker
+		    manifest_path: Optional run manifest shared by the workers, see `RunManifest`
+		    node_format: Format of the saved nodes, "json" or "parquet"
+		    embedding_matrix_dtype: "float32" or "float16" to save the embeddings in memory mapped matrices
+		"""
+		self.embedding_model_name = embedding_model_name
+		self.input_path = Path(input_path)
+		self.output_path = Path(output_path)
+		self.workers = workers
+		self.threads_per_worker = threads_per_worker or max(
+			1, (os.cpu_count() or 1) // workers
+		)
+		self.shards_per_worker = shards_per_worker
+		self.max_batch_tokens = max_batch_tokens
+		self.max_batch_size = max_batch_size
+		self.loader_workers = loader_workers
+		self.manifest_path = manifest_path
+		self.node_format = node_format
+		self.embedding_matrix_dtype = embedding_matrix_dtype
+		self.failed_documents: List[str] = []
+
+	def run(self, documents: Sequence[Path]) -> PipelineStats:
+		"""Embed every node of the documents across the workers, returning the merged statistics."""
+		stats = PipelineStats()
+		self.failed_documents = []
+		shards = shard_documents(documents, self.workers * self.shards_per_worker)
+		if not shards:
+			return stats
+		start_time = time.perf_counter()
+		# unique part names per run, the order of the rows is kept by the matrix index
+		run_id = time.strftime("%Y%m%dT%H%M%S")
+		logger.info(
+			f"Embedding {len(documents)} documents in {len(shards)} shards with "
+			f"{self.workers} workers of {self.threads_per_worker} threads"
+		)
+		# spawn rather than fork, torch and the tokenizers are not fork safe once initialized
+		with ProcessPoolExecutor(
+			max_workers=self.workers,
+			mp_context=multiprocessing.get_context("spawn"),
+			initializer=_init_worker,
+			initargs=(
+				self.embedding_model_name,
+				self.input_path,
+				self.output_path,
+				self.threads_per_worker,
+				self.max_batch_tokens,
+				self.max_batch_size,
+				self.loader_workers,
+				self.manifest_path,
+				self.node_format,
+				self.embedding_matrix_dtype,
+			),
+		) as executor:
+			futures = [
+				executor.submit(
+					_embed_shard, shard, f"embeddings_{run_id}_{shard_index:04d}"
+				)
+				for shard_index, shard in enumerate(shards)
+			]
+			for future in as_completed(futures):
+				try:
+					shard_stats, failed_documents = future.result()
+				except Exception:
+					# the shards not started yet are dropped, the run fails anyway
+					for pending in futures:
+						pending.cancel()
+					raise
+				stats.merge(shard_stats)
+				self.failed_documents.extend(failed_documents)
+
+		stats.elapsed_seconds = time.perf_counter() - start_time
+		logger.info(
+			f"Embedded {stats.nodes} nodes from {stats.documents} documents "
+			f"({stats.skipped_documents} already embedded) in "
+			f"{stats.elapsed_seconds:.1f} s ({stats.nodes_per_second:.1f} nodes/s "
+			f"with {self.workers} workers, padding efficiency {stats.padding_efficiency:.0%}, "
+			f"{stats.duplicate_nodes} duplicate nodes saved "
+			f"{stats.deduplication_savings:.0%} of the tokens)"
+		)
+		if stats.errors:
+			raise RuntimeError(
+				f"The embedding workers failed: {'; '.join(stats.errors)}"
+			)
+		return stats
@@ -0,0 +1,136 @@
+"""Rank fusion of the result lists returned by the different retrieval legs.
+
+Every function takes result lists of (id, score) pairs, best first, and returns
+a single list of (id, fused_score) pairs sorted by decreasing fused score.
+"""
+
+from collections import defaultdict
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+ScoredIds = Sequence[Tuple[Hashable, float]]
+FusedIds = List[Tuple[Hashable, float]]
+
+RRF_K = 60
+
+
+def _resolve_weights(
+	result_lists: Sequence[ScoredIds], weights: Optional[Sequence[float]]
+) -> Sequence[float]:
+	if weights is None:
+		return [1.0] * len(result_lists)
+	if len(weights) != len(result_lists):
+		raise ValueError(
+			f"Expected {len(result_lists)} weights, one per result list, got {len(weights)}"
+		)
+	return weights
+
+
+def _min_max_normalize(results: ScoredIds) -> Dict[Hashable, float]:
+	"""Scale the scores of one result list to [0, 1] so lists with different score ranges can be summed."""
+	if not results:
+		return {}
+	scores = [score for _, score in results]
+	low, high = min(scores), max(scores)
+	if high == low:
+		return {identifier: 1.0 for identifier, _ in results}
+	return {identifier: (score - low) / (high - low) for identifier, score in results}
+
+
+def _sort(fused_scores: Dict[Hashable, float]) -> FusedIds:
+	return sorted(fused_scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def reciprocal_rank_fusion(
+	result_lists: Sequence[ScoredIds],
+	weights: Optional[Sequence[float]] = None,
+	k: int = RRF_K,
+) -> FusedIds:
+	"""
+	Reciprocal Rank Fusion: each list contributes weight / (k + rank) for every id it contains.
+
+	Only the ranks are used, so the score scales of the legs do not need to be comparable.
+	"""
+	weights = _resolve_weights(result_lists, weights)
+	fused_scores: Dict[Hashable, float] = defaultdict(float)
+	for results, weight in zip(result_lists, weights):
+		seen = set()
+		for rank, (identifier, _) in enumerate(results, start=1):
+			# an id repeated in one list only counts at its best rank
+			if identifier in seen:
+				continue
+			seen.add(identifier)
+			fused_scores[identifier] += weight / (k + rank)
+	return _sort(fused_scores)
+
+
+def comb_sum(
+	result_lists: Sequence[ScoredIds], weights: Optional[Sequence[float]] = None
+) -> FusedIds:
+	"""CombSUM: sum of the min-max normalized scores of every list containing the id."""
+	weights = _resolve_weights(result_lists, weights)
+	fused_scores: Dict[Hashable, float] = defaultdict(float)
+	for results, weight in zip(result_lists, weights):
+		for identifier, score in _min_max_normalize(results).items():
+			fused_scores[identifier] += weight * score
+	return _sort(fused_scores)
+
+
+def comb_mnz(
+	result_lists: Sequence[ScoredIds], weights: Optional[Sequence[float]] = None
+) -> FusedIds:
+	"""CombMNZ: CombSUM multiplied by the number of lists containing the id."""
+	weights = _resolve_weights(result_lists, weights)
+	fused_scores: Dict[Hashable, float] = defaultdict(float)
+	hit_counts: Dict[Hashable, int] = defaultdict(int)
+	for results, weight in zip(result_lists, weights):
+		for identifier, score in _min_max_normalize(results).items():
+			fused_scores[identifier] += weight * score
+			hit_counts[identifier] += 1
+	return _sort(
+		{
+			identifier: score * hit_counts[identifier]
+			for identifier, score in fused_scores.items()
+		}
+	)
+
+
+def weighted_score_fusion(
+	result_lists: Sequence[ScoredIds], weights: Optional[Sequence[float]] = None
+) -> FusedIds:
+	"""Convex combination of the min-max normalized scores, the weights are rescaled to sum to one."""
+	weights = _resolve_weights(result_lists, weights)
+	total_weight = sum(weights)
+	if total_weight <= 0:
+		raise ValueError("The fusion weights must sum to a positive value")
+	return comb_sum(result_lists, [weight / total_weight for weight in weights])
+
+
+FUSION_METHODS: Dict[str, Callable[..., FusedIds]] = {
+	"rrf": reciprocal_rank_fusion,
+	"weighted": weighted_score_fusion,
+	"combsum": comb_sum,
+	"combmnz": comb_mnz,
+}
+
+
+def fuse(
+	result_lists: Sequence[ScoredIds],
+	method: str = "rrf",
+	weights: Optional[Sequence[float]] = None,
+	limit: Optional[int] = None,
+) -> FusedIds:
+	"""
+	Fuse the result lists with the given method and keep the `limit` best ids.
+
+	Args:
+	    result_lists: One list of (id, score) pairs per retrieval leg
+	    method: One of "rrf", "weighted", "combsum" or "combmnz"
+	    weights: Optional weight per result list
+	    limit: Maximum number of fused ids to return, all of them if None
+	"""
+	if method not in FUSION_METHODS:
+		raise ValueError(
+			f"Unknown fusion method {method!r}, expected one of {sorted(FUSION_METHODS)}"
+		)
+	fused = FUSION_METHODS[method](result_lists, weights=weights)
+	return fused[:limit] if limit is not None else fused
@@ -1,13 +1,81 @@
-from typing import Any, List, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 from unicodedata import normalize as unicode_normalize
 
 import spacy
+from psycopg2 import sql
 from sentence_transformers import SentenceTransformer
 from spacy.language import Language
 from textacy import extract
 
+from src.rag.components.fusion import FUSION_METHODS, fuse
 from src.shared.custom_cross_encoder import CustomCrossEncoder
-from src.shared.database import execute_query, generate_database_connection
+from src.shared.database import (
+	execute_query,
+	generate_connection_pool,
+	pooled_connection,
+)
+from src.shared.logger import setup_logger
+from src.shared.text import normalize_text
+
+logger = setup_logger("hybrid_retriever")
+
+# textrank only needs the tokens, their part of speech and their lemma, no sentence boundaries
+SPACY_EXCLUDED_COMPONENTS = ["parser", "senter", "ner", "textcat", "entity_linker"]
+
+DOCUMENTS_TABLE = "haystack_documents"
+CONTENT_COLUMN = "content"
+
+
+def text_search_column_name(language: str, column_name: str = CONTENT_COLUMN) -> str:
+	"""Name of the stored tsvector column holding the column content for the language."""
+	return f"{column_name}_tsvector_{language}"
+
+
+def create_text_search_columns(
+	database_connection,
+	languages: Sequence[str],
+	table_name: str = DOCUMENTS_TABLE,
+	column_name: str = CONTENT_COLUMN,
+) -> None:
+	"""
+	Materialize one stored tsvector column per language and index it with GIN.
+
+	This is the migration needed by `HybridRetriever.keyword_search`, which reads the
+	precomputed column instead of calling to_tsvector on every row at query time.
+	Both statements are idempotent, running it again only adds the missing languages.
+	"""
+	with database_connection.cursor() as cursor:
+		for language in languages:
+			tsvector_column = text_search_column_name(language, column_name)
+			cursor.execute(
+				sql.SQL(
+					"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {tsvector_column} tsvector "
+					"GENERATED ALWAYS AS (to_tsvector({language}::regconfig, coalesce({column}, ''))) STORED"
+				).format(
+					table=sql.Identifier(table_name),
+					tsvector_column=sql.Identifier(tsvector_column),
+					language=sql.Literal(language),
+					column=sql.Identifier(column_name),
+				)
+			)
+			cursor.execute(
+				sql.SQL(
+					"CREATE INDEX IF NOT EXISTS {index_name} ON {table} USING GIN ({tsvector_column})"
+				).format(
+					index_name=sql.Identifier(
+						f"{table_name}_{tsvector_column}_gin_index"
+					),
+					table=sql.Identifier(table_name),
+					tsvector_column=sql.Identifier(tsvector_column),
+				)
+			)
+			logger.info(
+				f"Full-text search column '{tsvector_column}' and its GIN index are ready on '{table_name}'."
+			)
+	database_connection.commit()
 
 
 class HybridRetriever:
@@ -20,17 +88,44 @@ class HybridRetriever:
 		spacy_model: str,
 		language: str,
 		sentence_transformer_kwargs: dict,
+		max_connections: int = 4,
+		fusion_method: str = "rrf",
+		fusion_weights: Optional[Sequence[float]] = None,
+		candidate_budget: int = 10,
+		keyword_cache_size: int = 4096,
 	):
+		"""
+		Args:
+		    fusion_method: How the semantic and keyword results are fused, one of "rrf", "weighted", "combsum" or "combmnz"
+		    fusion_weights: Optional (semantic, keyword) weights used by the fusion
+		    candidate_budget: Maximum number of fused candidates sent to the cross encoder
+		    keyword_cache_size: Number of queries whose extracted keywords are memoized
+		"""
+		if fusion_method not in FUSION_METHODS:
+			raise ValueError(
+				f"Unknown fusion method {fusion_method!r}, expected one of {sorted(FUSION_METHODS)}"
+			)
 		sentence_transformer_model = SentenceTransformer(**sentence_transformer_kwargs)
 
 		cross_encoder = CustomCrossEncoder(**cross_encoder_kwargs)
 
-		spacy_model: Language = spacy.load(spacy_model)
-		self.database_connection = generate_database_connection()
+		spacy_model: Language = self.load_spacy_model(spacy_model)
+		# each leg of the hybrid search borrows its own connection
+		self.connection_pool = generate_connection_pool(max_connections=max_connections)
+		self.executor = ThreadPoolExecutor(
+			max_workers=max_connections, thread_name_prefix="hybrid-retriever"
+		)
+		self.last_timings: Dict[str, float] = {}
 		self.sentence_transformer_model = sentence_transformer_model
 		self.cross_encoder = cross_encoder
 		self.spacy_model = spacy_model
 		self.language = language
+		self.fusion_method = fusion_method
+		self.fusion_weights = fusion_weights
+		self.candidate_budget = candidate_budget
+		self._cached_keyword_extraction = lru_cache(maxsize=keyword_cache_size)(
+			self._extract_keywords
+		)
 
 	def semantic_search(self, query: str, limit: int = 5) -> List[Any]:
 		"""
@@ -39,53 +134,169 @@ class HybridRetriever:
 		and then retrieve the embedding that are similar to the query string.
 		"""
 		embedding = self.sentence_transformer_model.encode(query)
-		semantic_search_query = "SELECT id, content FROM haystack_documents ORDER BY embedding <=> %(embedding)s LIMIT %(limit)s"
-		results = execute_query(
-			self.database_connection,
-			semantic_search_query,
-			{"embedding": str(embedding.tolist()), "limit": limit},
-		)
+		semantic_search_query = "SELECT id, content, 1 - (embedding <=> %(embedding)s) AS score FROM haystack_documents ORDER BY embedding <=> %(embedding)s LIMIT %(limit)s"
+		with pooled_connection(self.connection_pool) as connection:
+			results = execute_query(
+				connection,
+				semantic_search_query,
+				{"embedding": str(embedding.tolist()), "limit": limit},
+			)
 		return results
 
 	def keyword_search(self, keywords: str, limit: int = 5) -> List[Any]:
-		"""This function will perform keyword search"""
-		keyword_search_query_string = """SELECT id, content
-                                    FROM haystack_documents, websearch_to_tsquery(%(language)s, %(keywords)s) query
-                                      WHERE to_tsvector(%(language)s, content) @@ query
-                                    ORDER BY ts_rank_cd(to_tsvector(%(language)s, content), query) DESC LIMIT %(limit)s;"""
-		results = execute_query(
-			self.database_connection,
-			keyword_search_query_string,
-			{"language": self.language, "keywords": keywords, "limit": limit},
+		"""This function will perform keyword search.
+
+		It reads the stored tsvector column of the language, see `create_text_search_columns`.
+		"""
+		keyword_search_query_string = sql.SQL(
+			"""SELECT id, content, ts_rank_cd({tsvector_column}, query) AS score
+                                    FROM {table}, websearch_to_tsquery(%(language)s::regconfig, %(keywords)s) query
+                                      WHERE {tsvector_column} @@ query
+                                    ORDER BY score DESC LIMIT %(limit)s;"""
+		).format(
+			table=sql.Identifier(DOCUMENTS_TABLE),
+			tsvector_column=sql.Identifier(text_search_column_name(self.language)),
 		)
+		with pooled_connection(self.connection_pool) as connection:
+			results = execute_query(
+				connection,
+				keyword_search_query_string,
+				{"language": self.language, "keywords": keywords, "limit": limit},
+			)
 		return results
 
+	@staticmethod
+	def load_spacy_model(spacy_model: str) -> Language:
+		"""Load the spacy pipeline without the components textrank does not use."""
+		nlp = spacy.load(spacy_model, exclude=SPACY_EXCLUDED_COMPONENTS)
+		logger.info(f"Loaded spacy pipeline {spacy_model} with {nlp.pipe_names}")
+		return nlp
+
 	def perform_keyword_extraction(self, text: str) -> str:
 		"""This function will perform keyword extraction the text supplied.
 		It used spacy and texacy and will perform keyword exraction and will return those top keywords ready to be used in websearch_text
 		function.
 		The keywords will be combined with 'or' operator.
+		The results are memoized per normalized text.
 		"""
-		spacy_doc = self.spacy_model(text)
+		return self._cached_keyword_extraction(normalize_text(text))
+
+	def perform_keyword_extraction_batch(
+		self, texts: List[str], batch_size: int = 64, n_process: int = 1
+	) -> List[str]:
+		"""Extract the keywords of many texts with `nlp.pipe`, for offline evaluation runs."""
+		normalized_texts = [normalize_text(text) for text in texts]
+		spacy_docs = self.spacy_model.pipe(
+			normalized_texts, batch_size=batch_size, n_process=n_process
+		)
+		return [self._keywords_from_doc(spacy_doc) for spacy_doc in spacy_docs]
+
+	def _extract_keywords(self, text: str) -> str:
+		return self._keywords_from_doc(self.spacy_model(text))
+
+	@staticmethod
+	def _keywords_from_doc(spacy_doc) -> str:
 		term_keys = extract.keyterms.textrank(spacy_doc, normalize="lemma", topn=3)
 		return " or ".join([f'"{term[0]}"' for term in term_keys])
 
+	def fuse_results(self, *result_lists: List[Any]) -> List[Tuple[int, str]]:
+		"""Fuse the (id, content, score) rows of the retrieval legs and keep the candidate budget.
+
+		Returns the (id, content) pairs of the best fused candidates, best first.
+		"""
+		contents = {row[0]: row[1] for rows in result_lists for row in rows}
+		fused = fuse(
+			[[(row[0], row[2]) for row in rows] for rows in result_lists],
+			method=self.fusion_method,
+			weights=self.fusion_weights,
+			limit=self.candidate_budget,
+		)
+		return [(identifier, contents[identifier]) for identifier, _ in fused]
+
 	def rerank(self, query: str, results: List[Tuple[int, str]]) -> List[Any]:
 		"""this function rerank the results based on the their similarity with the question"""
-		results = [result[1] for result in results]
-		results = set(results)
-		# re-rank
-		scores = self.cross_encoder.predict([(query, item) for item in results])
-		return [v for _, v in sorted(zip(scores, results, strict=False), reverse=True)]
+		# deduplicate on the id while keeping the fused order
+		unique_results = {result[0]: result[1] for result in results}
+		contents = list(unique_results.values())
+		if not contents:
+			return []
+		ranking = self.cross_encoder.rank_passages(
+			query,
+			contents,
+			passage_ids=[str(identifier) for identifier in unique_results],
+		)
+		return [contents[index] for index, _ in ranking]
 
 	def run(self, query: str) -> List[Any]:
-		"""This function will run the hybrid retriever and will return the results"""
-		semantic_results = self.semantic_search(query)
-		keywords = self.perform_keyword_extraction(query)
-		keyword_results = self.keyword_search(keywords)
-		results = semantic_results + keyword_results
-		re_ranked_results = self.rerank(query, results)
+		"""This function will run the hybrid retriever and will return the results.
+
+		The semantic leg runs in the background while the keywords are extracted,
+		then the keyword leg runs concurrently with it on its own connection.
+		"""
+		timings: Dict[str, float] = {}
+		start = time.perf_counter()
+		semantic_future = self.executor.submit(
+			self._timed, timings, "semantic_search", self.semantic_search, query
+		)
+		keywords = self._timed(
+			timings, "keyword_extraction", self.perform_keyword_extraction, query
+		)
+		keyword_future = self.executor.submit(
+			self._timed, timings, "keyword_search", self.keyword_search, keywords
+		)
+		results = self._timed(
+			timings,
+			"fusion",
+			self.fuse_results,
+			semantic_future.result(),
+			keyword_future.result(),
+		)
+		timings["retrieval"] = time.perf_counter() - start
+		re_ranked_results = self._timed(timings, "rerank", self.rerank, query, results)
 		re_ranked_results = [
 			unicode_normalize("NFC", result) for result in re_ranked_results
 		]
+		timings["total"] = time.perf_counter() - start
+		self.last_timings = timings
+		formatted_timings = ", ".join(
+			f"{stage}={duration * 1000:.1f}" for stage, duration in timings.items()
+		)
+		logger.info(f"Hybrid retrieval timings (ms): {formatted_timings}")
 		return re_ranked_results
+
+	@staticmethod
+	def _timed(timings: Dict[str, float], stage: str, function: Callable, *args) -> Any:
+		"""Run the function and record how long it took under the stage name."""
+		start = time.perf_counter()
+		try:
+			return function(*args)
+		finally:
+			timings[stage] = time.perf_counter() - start
+
+	def close(self) -> None:
+		"""Release the worker threads and the database connections."""
+		self.executor.shutdown(wait=True)
+		self.connection_pool.closeall()
+
+
+if __name__ == "__main__":
+	import argparse
+
+	from src.shared.database import generate_database_connection
+
+	parser = argparse.ArgumentParser(
+		description="Create the stored tsvector columns used by the keyword search."
+	)
+	parser.add_argument(
+		"--languages",
+		type=str,
+		nargs="+",
+		default=["english"],
+		help="Text search configurations to materialize, e.g. english french.",
+	)
+	args = parser.parse_args()
+	connection = generate_database_connection()
+	try:
+		create_text_search_columns(connection, args.languages)
+	finally:
+		connection.close()
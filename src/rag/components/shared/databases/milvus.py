@@ -1,15 +1,24 @@
-from typing import Dict, List
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from injector import inject, singleton
 from pymilvus import DataType, MilvusClient
 from pymilvus.orm.collection import CollectionSchema
 
-from rag.components.shared.databases.settings import MilvusSettings
+from src.rag.components.shared.databases.settings import (
+	MilvusSearchParams,
+	MilvusSettings,
+)
 from src.rag.schemas.document import Node
 from src.shared.logger import setup_logger
 
 logger = setup_logger("milvus_database")
 
+# collection property bumped on every write, readers use it to invalidate their caches
+GENERATION_PROPERTY = "ingestion.generation"
+COLLECTION_NOT_FOUND_CODE = 100
+
 
 @singleton
 class MilvusDatabase:
@@ -22,8 +31,12 @@ class MilvusDatabase:
 		self.vector_dimension = self.settings.vector_dimension
 		self.collection_name = self.settings.collection_name
 		self.embedding_field_name = "embeddings"
+		self._collection_exists: Optional[bool] = None
+		self._stop_refresh = threading.Event()
 
 		self.connect()
+		self.refresh_collection_state()
+		self.start_collection_state_refresh()
 
 	def connect(self):
 		logger.info("Connecting to Milvus...")
@@ -59,6 +72,7 @@ class MilvusDatabase:
 			)
 
 			logger.info(f"Created collection '{collection_name}'.")
+		self._collection_exists = True
 
 	def write_data(self, data: List[Dict]):
 		logger.info("Writing embeddings to Milvus...")
@@ -75,9 +89,34 @@ class MilvusDatabase:
 		except Exception as e:
 			logger.error(f"Failed to insert entities into Milvus: {str(e)}")
 			raise
+		self.bump_collection_generation()
 
 		logger.info("Completed writing embeddings to Milvus.")
 
+	def bump_collection_generation(self) -> Optional[str]:
+		"""Mark the collection content as changed by storing a new generation in its properties."""
+		generation = str(time.time_ns())
+		try:
+			self.client.alter_collection_properties(
+				collection_name=self.collection_name,
+				properties={GENERATION_PROPERTY: generation},
+			)
+			return generation
+		except Exception as e:
+			logger.warning(f"Failed to update the collection generation: {str(e)}")
+			return None
+
+	def get_collection_generation(self) -> Optional[str]:
+		"""
+		Return the generation of the collection content, None if it was never set.
+
+		Raises:
+		    Exception: The error of milvus when the collection cannot be described, so it is
+		        not mistaken for a collection without generation.
+		"""
+		description = self.client.describe_collection(self.collection_name)
+		return description.get("properties", {}).get(GENERATION_PROPERTY)
+
 	def create_schema(self) -> CollectionSchema:
 		"""Create a milvus Schemas"""
 		schema = Node.to_milvus_schema(self.client)
@@ -94,28 +133,138 @@ class MilvusDatabase:
 			logger.info(f"Deleted collection '{collection_name}'.")
 		else:
 			logger.info(f"Collection '{collection_name}' does not exist.")
+		self._collection_exists = False
+
+	@property
+	def collection_exists(self) -> bool:
+		"""Cached existence of the collection, checked against the server only when unknown."""
+		if self._collection_exists is None:
+			self.refresh_collection_state()
+		return bool(self._collection_exists)
+
+	def refresh_collection_state(self) -> Optional[bool]:
+		"""Check whether the collection exists and cache the answer."""
+		try:
+			self._collection_exists = self.client.has_collection(self.collection_name)
+		except Exception as e:
+			logger.warning(f"Failed to check the collection state: {str(e)}")
+			self._collection_exists = None
+		return self._collection_exists
+
+	def start_collection_state_refresh(self) -> None:
+		"""Refresh the collection state periodically in a daemon thread."""
+		interval = self.settings.collection_state_refresh_seconds
+		if not interval:
+			return
+
+		def refresh_loop():
+			while not self._stop_refresh.wait(interval):
+				self.refresh_collection_state()
 
-	def search(self, query_vector: List[float], top_k: int = 5) -> List[Dict]:
+		threading.Thread(
+			target=refresh_loop, name="milvus-collection-state", daemon=True
+		).start()
+
+	def stop_collection_state_refresh(self) -> None:
+		self._stop_refresh.set()
+
+	@staticmethod
+	def is_collection_not_found(error: Exception) -> bool:
+		return (
+			getattr(error, "code", None) == COLLECTION_NOT_FOUND_CODE
+			or "collection not found" in str(error).lower()
+		)
+
+	def search(
+		self,
+		query_vector: List[List[float]],
+		top_k: int = 5,
+		search_params: Optional[MilvusSearchParams] = None,
+		output_fields: Optional[Sequence[str]] = None,
+	) -> List[List[Dict]]:
+		"""
+		Search the collection, returning one list of hits per query vector.
+
+		Args:
+		    query_vector: The query vectors, all searched in a single request
+		    top_k: Number of hits to return per query vector
+		    search_params: Optional ef, nprobe and consistency level for this search
+		    output_fields: Fields returned with each hit, all the node fields by default.
+		        Pass an empty list to only get the ids and the scores.
+		"""
 		if self.client is None:
 			self.connect()
 
-		if not self.client.has_collection(self.collection_name):
+		if not self.collection_exists:
 			logger.error(f"Collection '{self.collection_name}' does not exist.")
 			return []
 
+		search_params = search_params or MilvusSearchParams()
+		extra_kwargs = {}
+		if search_params.consistency_level is not None:
+			extra_kwargs["consistency_level"] = search_params.consistency_level
 		try:
 			results = self.client.search(
 				collection_name=self.collection_name,
 				data=query_vector,
 				limit=top_k,
-				output_fields=Node.keys(),
-				params={"metric_type": "COSINE"},
+				output_fields=Node.keys() if output_fields is None else output_fields,
+				search_params=search_params.to_search_params(),
+				**extra_kwargs,
 			)
 			return results
 		except Exception as e:
+			if self.is_collection_not_found(e):
+				logger.error(f"Collection '{self.collection_name}' was not found.")
+				self.refresh_collection_state()
+				return []
 			logger.error(f"Failed to search in Milvus: {str(e)}")
 			return []
 
+	def search_ids(
+		self,
+		query_vector: List[List[float]],
+		top_k: int = 5,
+		search_params: Optional[MilvusSearchParams] = None,
+	) -> List[List[Tuple[str, float]]]:
+		"""First phase of a search: only the (node_id, score) pairs of the hits, without any payload."""
+		results = self.search(
+			query_vector=query_vector,
+			top_k=top_k,
+			search_params=search_params,
+			output_fields=[],
+		)
+		return [[(hit["id"], hit["distance"]) for hit in hits] for hits in results]
+
+	def fetch_entities(
+		self, node_ids: Sequence[str], output_fields: Optional[Sequence[str]] = None
+	) -> Dict[str, Dict[str, Any]]:
+		"""
+		Second phase of a search: fetch the payload of the given nodes only.
+
+		Args:
+		    node_ids: Primary keys of the nodes to fetch
+		    output_fields: Fields to fetch, all the node fields by default
+
+		Returns:
+		    The entities keyed by node_id
+		"""
+		if not node_ids:
+			return {}
+		fields = list(Node.keys() if output_fields is None else output_fields)
+		if "node_id" not in fields:
+			fields.append("node_id")
+		try:
+			entities = self.client.get(
+				collection_name=self.collection_name,
+				ids=list(node_ids),
+				output_fields=fields,
+			)
+		except Exception as e:
+			logger.error(f"Failed to fetch entities from Milvus: {str(e)}")
+			return {}
+		return {entity["node_id"]: entity for entity in entities}
+
 	def to_milvus_schema(self) -> CollectionSchema:
 		"""Create a milvus schemas for the node class."""
 		schema = self.milvus_client.create_schema(
@@ -1,15 +1,16 @@
 import contextlib
 import csv
-from collections import defaultdict
+import threading
+from datetime import datetime
 from enum import Enum
-from itertools import groupby
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Sequence, Tuple, TypeVar
 
 import numpy as np
 from pgvector.psycopg import register_vector
-from psycopg import Connection, sql
+from psycopg import Connection, connect, sql
 from psycopg.pq import TransactionStatus
+from psycopg.types.json import Json
 
 from src.shared.logger import setup_logger
 
@@ -21,6 +22,9 @@ Vector = np.ndarray
 DEFAULT_TOKENIZER = "bert_base_uncased"
 
 DISTANCE_OPS_MAPPING = {"cosine": "<=>", "l2": "<->", "inner": "<#>"}
+JSON_TYPES = ("json", "jsonb")
+TIMESTAMP_TYPES = ("timestamp", "timestamptz")
+INDEX_PROGRESS_INTERVAL_SECONDS = 30.0
 
 
 class DistanceMetric(str, Enum):
@@ -139,7 +143,7 @@ class PostgresVectorDBClient:
 			column=sql.Identifier(column_name),
 			config=sql.SQL(index_config),
 		)
-		with self._transaction() as cursor:
+		with self._index_build_progress(), self._transaction() as cursor:
 			cursor.execute(query)
 
 	def create_full_text_index(self, table_name: str, column_name: str) -> None:
@@ -152,7 +156,7 @@ class PostgresVectorDBClient:
 		"""
 		full_text_search_column = f"full_text_search_{column_name}"
 		query = sql.SQL(
-			"CREATE INDEX {index_name} ON {table} USING GIN ({tsvector_column})"
+			"CREATE INDEX IF NOT EXISTS {index_name} ON {table} USING GIN ({tsvector_column})"
 		).format(
 			index_name=sql.Identifier(
 				f"{self.namespace}_{table_name}_{full_text_search_column}_fts_index"
@@ -160,12 +164,203 @@ class PostgresVectorDBClient:
 			table=self._full_table_name(table_name),
 			tsvector_column=sql.Identifier(full_text_search_column),
 		)
-		with self._transaction() as cursor:
+		with self._index_build_progress(), self._transaction() as cursor:
 			cursor.execute(query)
 			logger.info(
 				f"Full-text search index created on '{full_text_search_column}' in table '{table_name}'."
 			)
 
+	def list_secondary_indexes(self, table_name: str) -> List[Tuple[str, str]]:
+		"""
+		List the indexes of a table that back no constraint, such as the vector and full-text indexes.
+
+		Returns:
+		    List of (index_name, index_definition) tuples
+		"""
+		with self._transaction() as cursor:
+			cursor.execute(
+				"SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid) "
+				"FROM pg_index JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+				"WHERE pg_index.indrelid = %s::regclass AND NOT EXISTS ("
+				"SELECT 1 FROM pg_constraint WHERE pg_constraint.conindid = pg_index.indexrelid)",
+				(self._full_table_name(table_name).as_string(cursor),),
+			)
+			return cursor.fetchall()
+
+	def drop_index(self, index_name: str, if_exists: bool = True) -> None:
+		"""Drop an index by name."""
+		query = sql.SQL("DROP INDEX {if_exists} {index}").format(
+			if_exists=sql.SQL("IF EXISTS") if if_exists else sql.SQL(""),
+			index=sql.Identifier(index_name),
+		)
+		with self._transaction() as cursor:
+			cursor.execute(query)
+			logger.info(f"Index '{index_name}' dropped.")
+
+	def set_table_logged(self, table_name: str, logged: bool) -> None:
+		"""Switch a table between LOGGED and UNLOGGED, an unlogged table skips the WAL but is emptied after a crash."""
+		query = sql.SQL("ALTER TABLE {table} SET {mode}").format(
+			table=self._full_table_name(table_name),
+			mode=sql.SQL("LOGGED" if logged else "UNLOGGED"),
+		)
+		with self._transaction() as cursor:
+			cursor.execute(query)
+			logger.info(
+				f"Table '{table_name}' set {'LOGGED' if logged else 'UNLOGGED'}."
+			)
+
+	@contextlib.contextmanager
+	def maintenance_settings(
+		self,
+		maintenance_work_mem: Optional[str] = None,
+		max_parallel_maintenance_workers: Optional[int] = None,
+	):
+		"""
+		Tune the index builds of the session, the settings are reset on exit.
+
+		Args:
+		    maintenance_work_mem: Memory of an index build, e.g. "4GB"
+		    max_parallel_maintenance_workers: Parallel workers of an index build
+		"""
+		settings = {
+			"maintenance_work_mem": maintenance_work_mem,
+			"max_parallel_maintenance_workers": max_parallel_maintenance_workers,
+		}
+		settings = {
+			name: value for name, value in settings.items() if value is not None
+		}
+		with self._transaction() as cursor:
+			for name, value in settings.items():
+				cursor.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+		try:
+			yield
+		finally:
+			with self._transaction() as cursor:
+				for name in settings:
+					cursor.execute(
+						sql.SQL("RESET {name}").format(name=sql.Identifier(name))
+					)
+
+	def rebuild_indexes(
+		self, index_definitions: Sequence[str], concurrently: bool = True
+	) -> None:
+		"""
+		Create the indexes from their definitions, as returned by `list_secondary_indexes`.
+
+		With `concurrently`, the indexes are built with CREATE INDEX CONCURRENTLY, so the
+		tables stay writable during the build. This requires an autocommit connection.
+		"""
+		if concurrently and not self.connection.autocommit:
+			raise ValueError(
+				"Building indexes concurrently requires an autocommit connection"
+			)
+		for definition in index_definitions:
+			if concurrently:
+				definition = definition.replace(
+					"CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1
+				).replace("CREATE UNIQUE INDEX", "CREATE UNIQUE INDEX CONCURRENTLY", 1)
+			logger.info(f"Building index: {definition}")
+			with self._index_build_progress():
+				if concurrently:
+					# CONCURRENTLY cannot run inside a transaction block
+					self.connection.execute(definition)
+				else:
+					with self._transaction() as cursor:
+						cursor.execute(definition)
+
+	@contextlib.contextmanager
+	def bulk_load(
+		self,
+		table_names: Sequence[str],
+		unlogged: bool = False,
+		concurrently: bool = True,
+		maintenance_work_mem: Optional[str] = None,
+		max_parallel_maintenance_workers: Optional[int] = None,
+	):
+		"""
+		Ingestion mode dropping the secondary indexes of the tables during the load.
+
+		The vector and full-text indexes are dropped on entry and rebuilt once on exit
+		with the tuned maintenance settings, instead of being updated row by row.
+
+		Args:
+		    table_names: Tables being loaded (without namespace prefix)
+		    unlogged: Set the tables UNLOGGED during the load, they are set LOGGED again
+		        on exit, which writes them to the WAL once
+		    concurrently: Rebuild the indexes with CREATE INDEX CONCURRENTLY
+		    maintenance_work_mem: Memory of each index build, e.g. "4GB"
+		    max_parallel_maintenance_workers: Parallel workers of each index build
+		"""
+		index_definitions = []
+		for table_name in table_names:
+			for index_name, definition in self.list_secondary_indexes(table_name):
+				self.drop_index(index_name)
+				index_definitions.append(definition)
+			if unlogged:
+				self.set_table_logged(table_name, logged=False)
+		try:
+			yield
+		finally:
+			if unlogged:
+				for table_name in table_names:
+					self.set_table_logged(table_name, logged=True)
+			with self.maintenance_settings(
+				maintenance_work_mem, max_parallel_maintenance_workers
+			):
+				self.rebuild_indexes(index_definitions, concurrently=concurrently)
+
+	@contextlib.contextmanager
+	def _index_build_progress(
+		self, interval_seconds: float = INDEX_PROGRESS_INTERVAL_SECONDS
+	):
+		"""Log the progress of the index builds of this connection from `pg_stat_progress_create_index`."""
+		backend_pid = self.connection.info.backend_pid
+		stop = threading.Event()
+
+		def report_progress():
+			try:
+				# the build blocks the client connection, so the progress is read from another one
+				with connect(
+					**self.connection.info.get_parameters(),
+					password=self.connection.info.password,
+					autocommit=True,
+				) as monitor:
+					while not stop.wait(interval_seconds):
+						row = monitor.execute(
+							"SELECT index_relid::regclass::text, phase, blocks_done, blocks_total, "
+							"tuples_done, tuples_total FROM pg_stat_progress_create_index WHERE pid = %s",
+							(backend_pid,),
+						).fetchone()
+						if row is None:
+							continue
+						(
+							index_name,
+							phase,
+							blocks_done,
+							blocks_total,
+							tuples_done,
+							tuples_total,
+						) = row
+						done, total = (
+							(blocks_done, blocks_total)
+							if blocks_total
+							else (tuples_done, tuples_total)
+						)
+						percent = f" {100 * done / total:.0f}%" if total else ""
+						logger.info(f"Index build {index_name}: {phase}{percent}")
+			except Exception as e:
+				logger.warning(f"Cannot report the index build progress: {str(e)}")
+
+		monitor_thread = threading.Thread(
+			target=report_progress, name="index-build-progress", daemon=True
+		)
+		monitor_thread.start()
+		try:
+			yield
+		finally:
+			stop.set()
+			monitor_thread.join()
+
 	def insert(
 		self,
 		table_name: str,
@@ -313,6 +508,127 @@ class PostgresVectorDBClient:
 				)
 				return None
 
+	def bulk_copy(
+		self,
+		table_name: str,
+		data: Sequence[Dict[str, Any]],
+		returning: Optional[Sequence[str]] = None,
+	) -> Optional[List[Tuple[Any, ...]]]:
+		"""
+		Insert multiple records through a binary COPY, with the conflict semantics of `bulk_insert`.
+
+		The rows are streamed with `COPY ... FROM STDIN (FORMAT BINARY)` into a temporary
+		staging table with the column types of the target table, so the vectors are sent
+		in the binary pgvector format instead of text. The staging table is then merged
+		with `INSERT ... SELECT ... ON CONFLICT DO NOTHING`, in the same transaction.
+
+		Args:
+		    table_name: Name of the table
+		    data: Sequence of dictionaries with column names and values, the JSON
+		        columns accept python objects or already serialized strings
+		    returning: Optional columns of the inserted rows to return
+
+		Returns:
+		    List of returned rows if 'returning' specified, else None
+		"""
+		if not data:
+			return [] if returning else None
+
+		columns = list(data[0].keys())
+		table = self._full_table_name(table_name)
+		staging_table = sql.Identifier(f"{self.namespace}_{table_name}_staging")
+		column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+
+		with self._transaction() as cursor:
+			column_types = self._column_types(cursor, table, columns)
+			cursor.execute(
+				sql.SQL(
+					"CREATE TEMPORARY TABLE IF NOT EXISTS {staging} "
+					"AS SELECT {columns} FROM {table} WITH NO DATA"
+				).format(staging=staging_table, columns=column_list, table=table)
+			)
+			# the staging table outlives the transaction when the connection is reused
+			cursor.execute(sql.SQL("TRUNCATE {staging}").format(staging=staging_table))
+			with cursor.copy(
+				sql.SQL("COPY {staging} ({columns}) FROM STDIN (FORMAT BINARY)").format(
+					staging=staging_table, columns=column_list
+				)
+			) as copy:
+				copy.set_types(column_types)
+				for item in data:
+					copy.write_row(
+						[
+							self._copy_value(item[column], column_type)
+							for column, column_type in zip(columns, column_types)
+						]
+					)
+
+			query = sql.SQL(
+				"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} "
+				"ON CONFLICT DO NOTHING"
+			).format(table=table, columns=column_list, staging=staging_table)
+			if returning:
+				query = sql.SQL("{query} RETURNING {returning}").format(
+					query=query,
+					returning=sql.SQL(", ").join(map(sql.Identifier, returning)),
+				)
+			cursor.execute(query)
+			logger.info(
+				f"Copied {len(data)} rows into '{table_name}', {cursor.rowcount} inserted"
+			)
+			return cursor.fetchall() if returning else None
+
+	def _column_types(
+		self, cursor, table: sql.Identifier, columns: Sequence[str]
+	) -> List[str]:
+		"""Names of the types of the columns, as expected by `Copy.set_types`."""
+		cursor.execute(
+			"SELECT a.attname, t.typname FROM pg_attribute a "
+			"JOIN pg_type t ON t.oid = a.atttypid "
+			"WHERE a.attrelid = %s::regclass AND a.attname = ANY(%s) AND NOT a.attisdropped",
+			(table.as_string(cursor), list(columns)),
+		)
+		type_names = dict(cursor.fetchall())
+		missing_columns = [column for column in columns if column not in type_names]
+		if missing_columns:
+			raise ValueError(f"Unknown columns {missing_columns} in table {table}")
+		# array types are named after their element type with a leading underscore
+		return [
+			f"{type_names[column][1:]}[]"
+			if type_names[column].startswith("_")
+			else type_names[column]
+			for column in columns
+		]
+
+	@staticmethod
+	def _copy_value(value: Any, column_type: str) -> Any:
+		"""Adapt a value to the binary dumper of its column."""
+		if value is None:
+			return None
+		if column_type in JSON_TYPES:
+			# serialized strings are sent as they are instead of being encoded again
+			if isinstance(value, str):
+				return Json(value, dumps=lambda serialized: serialized)
+			return Json(value)
+		if column_type == "vector":
+			return np.asarray(value, dtype=np.float32)
+		if column_type in TIMESTAMP_TYPES:
+			# the binary dumpers are chosen from the column type, not from the value,
+			# so ISO strings of json dumps and naive datetimes reach the timestamptz dumper
+			if isinstance(value, str):
+				value = datetime.fromisoformat(value)
+			if column_type == "timestamptz" and value.tzinfo is None:
+				# naive datetimes are local times, as built by datetime.fromtimestamp
+				return value.astimezone()
+			if column_type == "timestamp" and value.tzinfo is not None:
+				return value.replace(tzinfo=None)
+		return value
+
+	@staticmethod
+	def _set_probes(cursor, probe: int) -> None:
+		"""Set the vchordrq probes for the current transaction, SET does not accept parameters."""
+		cursor.execute("SELECT set_config('vchordrq.probes', %s, true)", (str(probe),))
+
 	def search_by_vector(
 		self,
 		table_name: str,
@@ -357,9 +673,7 @@ class PostgresVectorDBClient:
 		)
 		with self._transaction() as cursor:
 			if probe:
-				cursor.execute(
-					sql.SQL("SET LOCAL vchordrq.probes = %s").format(), (probe,)
-				)
+				self._set_probes(cursor, probe)
 			cursor.execute(query, {"query_embedding": query_vector})
 			return cursor.fetchall()
 
@@ -521,26 +835,29 @@ class PostgresVectorDBClient:
 			cursor.execute(query)
 			logger.info(f"Constraint '{constraint_name}' dropped from '{table_name}'.")
 
-	def add_text_search_field(self, table_name: str, column_name: str):
+	def add_text_search_field(
+		self, table_name: str, column_name: str, language: str = "english"
+	):
 		"""
 		Add a tsvector column for full-text search.
 		Args:
 		    table_name: Name of the table
 		    column_name: The column to generate the tsvector from
+		    language: Text search configuration used to build the tsvector
 		"""
 		# Create the full column name for the tsvector field
 		full_text_search_column = f"full_text_search_{column_name}"
 
 		query = sql.SQL(
-			"ALTER TABLE {table} ADD COLUMN {tsvector_column} tsvector GENERATED ALWAYS AS (to_tsvector('english', {content_column})) STORED"
+			"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {tsvector_column} tsvector GENERATED ALWAYS AS (to_tsvector({language}::regconfig, {content_column})) STORED"
 		).format(
 			table=self._full_table_name(table_name),
 			tsvector_column=sql.Identifier(full_text_search_column),
+			language=sql.Literal(language),
 			content_column=sql.Identifier(column_name),
 		)
 
 		with self._transaction() as cursor:
-			print(query.as_string(cursor))
 			cursor.execute(query)
 			logger.info(
 				f"Column '{full_text_search_column}' added to '{table_name}' for full-text search."
@@ -550,106 +867,81 @@ class PostgresVectorDBClient:
 		self,
 		table_name: str,
 		vector_column: str,
-		query_vectors: List[List[float]],
+		query_vectors: Sequence[Vector],
 		return_columns: Sequence[str],
 		distance_metric: DistanceMetric = DistanceMetric.COSINE,
 		candidate_limit: int = 10,
 		probe: Optional[int] = None,
-	) -> List[Tuple[Any, ...]]:
+		explain: bool = False,
+	) -> List[List[Tuple[Any, ...]]]:
 		"""
-		Perform multiple vector similarity searches using LATERAL JOIN for efficiency.
+		Perform one vector similarity search per query vector in a single round trip.
+
+		The searches are independent `ORDER BY distance LIMIT k` queries, so each one
+		can be served by the vector index, sent in pipeline mode with the vectors
+		as binary pgvector parameters.
+
 		Args:
 		    table_name: Name of the table
 		    vector_column: Name of the vector column
-		    query_vectors: List of query vectors (n x m)
+		    query_vectors: Query vectors (n x m)
 		    return_columns: Columns to return in results
 		    distance_metric: One of "cosine", "l2", or "inner"
-		    candidate_limit: Number of candidates to consider per query
+		    candidate_limit: Number of results to return per query
 		    probe: Number of probes for approximate search
+		    explain: Log the EXPLAIN ANALYZE plan of the first search, it runs the query once more
 
 		Returns:
-		    List of result rows (one per query vector)
+		    One list of (similarity, *return_columns) rows per query vector, in the order of the query vectors
 		"""
-		distance_op = DISTANCE_OPS_MAPPING[distance_metric]
+		if len(query_vectors) == 0:
+			return []
 
+		distance = sql.SQL("{vector_column} {op} %(query_embedding)b").format(
+			vector_column=sql.Identifier(vector_column),
+			op=sql.SQL(DISTANCE_OPS_MAPPING[distance_metric]),
+		)
 		if distance_metric == DistanceMetric.COSINE:
-			# Cosine similarity (1 - distance)
-			similarity_expr = "(1 - ({vector_column} {op} qv.query_vector::vector))"
+			similarity = sql.SQL("(1 - ({distance}))").format(distance=distance)
 		elif distance_metric == DistanceMetric.INNER_PRODUCT:
-			# Inner product similarity: negate the pgvector operator result
-			# to get the positive inner product value.
-			similarity_expr = "(-({vector_column} {op} qv.query_vector::vector))"
+			# pgvector returns the negative inner product
+			similarity = sql.SQL("(-({distance}))").format(distance=distance)
 		else:  # L2
-			# L2 similarity: a common way to turn distance into similarity
-			similarity_expr = "(1 / (1 + {vector_column} {op} qv.query_vector::vector))"
-
-		array_constructor, params = self.convert_array_to_pg_vectors(query_vectors)
+			similarity = sql.SQL("(1 / (1 + {distance}))").format(distance=distance)
 
 		query = sql.SQL(
-			f"""
-            SELECT
-                results.*,
-                qv.idx as query_index
-            FROM
-                unnest({array_constructor}) WITH ORDINALITY AS qv(query_vector, idx)
-            CROSS JOIN LATERAL (
-                SELECT
-                    {{similarity}} as similarity,
-                    {{columns}}
-                FROM {{table}}
-                ORDER BY similarity desc
-                LIMIT {candidate_limit}
-            ) AS results
-            ORDER BY qv.idx, results.similarity DESC
-        """
+			"SELECT {similarity} AS similarity, {columns} FROM {table} "
+			"ORDER BY {distance} LIMIT {top_k}"
 		).format(
-			similarity=sql.SQL(
-				similarity_expr.format(
-					# Use quotes to prevent issues with reserved keywords
-					vector_column='"{}"'.format(vector_column),
-					op=distance_op,
-				)
-			),
+			similarity=similarity,
 			columns=sql.SQL(", ").join(map(sql.Identifier, return_columns)),
-			return_columns=sql.SQL(", ").join(map(sql.Identifier, return_columns)),
 			table=self._full_table_name(table_name),
-			candidate_limit=sql.Literal(candidate_limit),
-			vector_column=sql.Identifier(vector_column),
-			op=sql.SQL(distance_op),
+			distance=distance,
+			top_k=sql.Literal(candidate_limit),
 		)
+		params = [
+			{"query_embedding": np.asarray(query_vector, dtype=np.float32)}
+			for query_vector in query_vectors
+		]
 
 		with self._transaction() as cursor:
 			if probe:
-				cursor.execute(sql.SQL("SET LOCAL vchordrq.probes = %s"), (probe,))
-			print(query.as_string(cursor))
-			cursor.execute(f"explain analyze {query.as_string(cursor)}", params)
-			results = cursor.fetchall()
-
-			return self._extract_top_results(results, k=candidate_limit)
-
-	def _extract_top_results(
-		self, results: List[Tuple], k: int = 1
-	) -> List[Tuple[Any, ...]]:
-		"""
-		Groups results by query and returns the top k results for each.
-
-		Args:
-		    results: A list of result rows from the database, ordered by query index
-		             and then by similarity. Each row is (similarity, column1, ..., query_index).
-		    num_queries: The total number of query vectors.
-		    k: The number of top results to return for each query.
-
-		Returns:
-		    A flattened list of the top k result rows for all queries.
-		"""
-		if not results:
-			return []
-
-		# Use a defaultdict to group results by their query index
-		grouped_results = defaultdict(list)
-		for index, group in groupby(results, key=lambda x: x[-1]):
-			grouped_results[index] = list(group)[:k]
-		return grouped_results
+				self._set_probes(cursor, probe)
+			if explain:
+				cursor.execute(
+					sql.SQL("EXPLAIN (ANALYZE, BUFFERS) {query}").format(query=query),
+					params[0],
+				)
+				plan = "\n".join(row[0] for row in cursor.fetchall())
+				logger.info(
+					f"Plan of the first of {len(params)} vector searches:\n{plan}"
+				)
+			# executemany sends the queries in pipeline mode, returning=True keeps one result set per query
+			cursor.executemany(query, params, returning=True)
+			results = [cursor.fetchall()]
+			while cursor.nextset():
+				results.append(cursor.fetchall())
+			return results
 
 	def distance_metrics_to_similarity_expression(self, distance_metric: str) -> str:
 		if distance_metric == DistanceMetric.COSINE:
@@ -665,31 +957,3 @@ class PostgresVectorDBClient:
 				"(1 / (1 + {vector_column} {op} %(query_embedding)s::vector))"
 			)
 		return similarity_expr
-
-	def convert_array_to_pg_vectors(
-		self, query_vectors: List[List[float]]
-	) -> Tuple[List[str], Dict[str, str]]:
-		"""
-		convert a list of list to PostgresQL array format
-
-		It return the vector placeholder in this format:
-
-		'        array_constructor = f"ARRAY[{', '.join(vector_placeholders)}]"
-		and parameters like this:
-		vector_1:vector: values
-		vector_2:vector: values
-		...
-		vector_n:vector:    values
-		"""
-
-		vector_placeholders = []
-		params = {}
-		for i, vector in enumerate(query_vectors):
-			param_name = f"vector_{i}::vector"
-
-			vector_string = "[" + ",".join(str(float(x)) for x in vector) + "]"
-			vector_placeholders.append(f"%({param_name})s")
-			params[param_name] = vector_string
-		array_constructor = f"ARRAY[{', '.join(vector_placeholders)}]"
-
-		return array_constructor, params
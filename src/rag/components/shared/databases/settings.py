@@ -1,6 +1,6 @@
-from typing import NamedTuple, Optional
+from typing import Literal, NamedTuple, Optional
 
-from pydantic import BaseModel, Field, PositiveInt
+from pydantic import BaseModel, ConfigDict, Field, PositiveInt
 
 
 class DistanceOp(NamedTuple):
@@ -76,3 +76,71 @@ class PgVectorSettings(BaseModel):
 		min_length=1,
 		max_length=63,
 	)
+
+
+class MilvusSettings(BaseModel):
+	uri: str = Field(
+		"local_data/private_gpt/milvus/milvus_local.db",
+		description="The URI of the Milvus instance. For example: 'local_data/private_gpt/milvus/milvus_local.db' for Milvus Lite.",
+	)
+	token: str = Field(
+		"",
+		description=(
+			"A valid access token to access the specified Milvus instance. "
+			"This can be used as a recommended alternative to setting user and password separately. "
+		),
+	)
+	collection_name: str = Field(
+		"make_this_parameterizable_per_api_call",
+		description="The name of the collection in Milvus. Default is 'make_this_parameterizable_per_api_call'.",
+	)
+	overwrite: bool = Field(
+		True, description="Overwrite the previous collection schema if it exists."
+	)
+	vector_dimension: int = Field(
+		1024,
+		description=(
+			"The dimension of the vector. "
+			"This should match the dimension of the embeddings used in the collection."
+		),
+	)
+	collection_state_refresh_seconds: float = Field(
+		60,
+		description=(
+			"Interval between two background checks of the collection existence. "
+			"Set to 0 to only check at startup and when a search reports a missing collection."
+		),
+		ge=0,
+	)
+
+
+class MilvusSearchParams(BaseModel):
+	"""Per request search parameters trading recall for latency."""
+
+	model_config = ConfigDict(frozen=True)
+
+	ef: Optional[int] = Field(
+		default=None,
+		description="Size of the HNSW dynamic candidate list, larger values improve recall.",
+		gt=0,
+	)
+	nprobe: Optional[int] = Field(
+		default=None,
+		description="Number of IVF clusters to probe, larger values improve recall.",
+		gt=0,
+	)
+	consistency_level: Optional[
+		Literal["Strong", "Bounded", "Session", "Eventually"]
+	] = Field(
+		default=None,
+		description="Consistency level of the search, weaker levels return faster.",
+	)
+
+	def to_search_params(self, metric_type: str = "COSINE") -> dict:
+		"""Build the `search_params` argument of the Milvus client."""
+		params = {}
+		if self.ef is not None:
+			params["ef"] = self.ef
+		if self.nprobe is not None:
+			params["nprobe"] = self.nprobe
+		return {"metric_type": metric_type, "params": params}
@@ -0,0 +1,246 @@
+"""Memory mapped matrices of node embeddings, stored next to the node files.
+
+A matrix part is a `.npy` file holding one embedding per row, with a text file
+listing the node_id of every row. Parts only grow by appending rows, and the
+`.npy` header is rewritten after each append, so a part is always a valid file
+for `np.load(..., mmap_mode="r")`, even after a crash. Each writer, for example
+each shard of the embedding worker pool, owns its own part and readers open all
+of them.
+
+Every time a writer opens a part, it appends the part name and its first new row
+to the index of the folder. Readers replay the index in that order, so when a node
+was embedded more than once its most recently written row wins, whatever the names
+of the parts.
+"""
+
+import ast
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from src.rag.schemas.document import Node
+from src.shared.logger import setup_logger
+
+logger = setup_logger("embedding matrix")
+
+MATRIX_SUFFIX = ".npy"
+NODE_IDS_SUFFIX = ".node_ids.txt"
+# one "<part name>\t<first row>" line per opening of a part, in write order
+PARTS_INDEX = "parts.index"
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# fixed header size, so the header can be rewritten in place when the matrix grows
+NPY_HEADER_SIZE = 128
+
+
+def _npy_header(dtype: np.dtype, rows: int, vector_dimension: int) -> bytes:
+	header = repr(
+		{
+			"descr": np.lib.format.dtype_to_descr(dtype),
+			"fortran_order": False,
+			"shape": (rows, vector_dimension),
+		}
+	)
+	padding = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - len(header) - 1
+	header = header + " " * padding + "\n"
+	return NPY_MAGIC + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def _read_npy_header(matrix_path: Path) -> Dict:
+	with open(matrix_path, "rb") as file:
+		if file.read(len(NPY_MAGIC)) != NPY_MAGIC:
+			raise ValueError(f"{matrix_path} is not an appendable npy file")
+		header_length = int.from_bytes(file.read(2), "little")
+		if len(NPY_MAGIC) + 2 + header_length != NPY_HEADER_SIZE:
+			raise ValueError(f"{matrix_path} is not an appendable npy file")
+		return ast.literal_eval(file.read(header_length).decode("latin1"))
+
+
+class EmbeddingMatrixWriter:
+	"""Append embeddings and their node_id to a matrix part."""
+
+	def __init__(
+		self,
+		directory: Union[Path, str],
+		vector_dimension: int,
+		part_name: str = "embeddings",
+		dtype: Union[str, np.dtype] = np.float32,
+	):
+		"""
+		Args:
+		    directory: Folder of the matrix parts
+		    vector_dimension: Dimension of the embeddings
+		    part_name: Name of the part owned by this writer, unique per concurrent writer
+		    dtype: float32, or float16 to halve the size of the matrix
+		"""
+		self.directory = Path(directory)
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self.vector_dimension = vector_dimension
+		self.dtype = np.dtype(dtype)
+		if self.dtype not in (np.dtype(np.float32), np.dtype(np.float16)):
+			raise ValueError(f"Unsupported embedding dtype {self.dtype}")
+		self.matrix_path = self.directory.joinpath(f"{part_name}{MATRIX_SUFFIX}")
+		self.node_ids_path = self.directory.joinpath(f"{part_name}{NODE_IDS_SUFFIX}")
+		self.rows = self._open()
+		self._record_in_index()
+
+	def _record_in_index(self) -> None:
+		# a single short line in append mode, safe with the writers of other processes
+		with open(
+			self.directory.joinpath(PARTS_INDEX), "a", encoding="utf-8"
+		) as index_file:
+			index_file.write(f"{self.matrix_path.stem}\t{self.rows}\n")
+
+	def _open(self) -> int:
+		if not self.matrix_path.exists():
+			self.matrix_file = open(self.matrix_path, "w+b")
+			self.matrix_file.write(_npy_header(self.dtype, 0, self.vector_dimension))
+			self.node_ids_file = open(self.node_ids_path, "w", encoding="utf-8")
+			return 0
+		header = _read_npy_header(self.matrix_path)
+		if np.dtype(header["descr"]) != self.dtype or header["shape"][1:] != (
+			self.vector_dimension,
+		):
+			raise ValueError(
+				f"{self.matrix_path} holds {header['descr']} vectors of shape {header['shape']}, "
+				f"expected {self.dtype} vectors of dimension {self.vector_dimension}"
+			)
+		node_ids = self.node_ids_path.read_text(encoding="utf-8").splitlines()
+		row_size = self.dtype.itemsize * self.vector_dimension
+		written_rows = (self.matrix_path.stat().st_size - NPY_HEADER_SIZE) // row_size
+		# an interrupted append leaves one of the files ahead of the other
+		rows = min(written_rows, len(node_ids))
+		self.matrix_file = open(self.matrix_path, "r+b")
+		self.matrix_file.truncate(NPY_HEADER_SIZE + rows * row_size)
+		self.node_ids_file = open(self.node_ids_path, "w", encoding="utf-8")
+		self.node_ids_file.writelines(f"{node_id}\n" for node_id in node_ids[:rows])
+		self._write_header(rows)
+		logger.info(f"Appending to {self.matrix_path} after {rows} rows")
+		return rows
+
+	def _write_header(self, rows: int) -> None:
+		self.matrix_file.seek(0)
+		self.matrix_file.write(_npy_header(self.dtype, rows, self.vector_dimension))
+		self.matrix_file.seek(0, 2)
+
+	def append(self, node_ids: Sequence[str], embeddings: np.ndarray) -> None:
+		"""Append one row per node, in the order of the node_ids."""
+		embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+		if embeddings.shape != (len(node_ids), self.vector_dimension):
+			raise ValueError(
+				f"Expected embeddings of shape {(len(node_ids), self.vector_dimension)}, "
+				f"got {embeddings.shape}"
+			)
+		self.matrix_file.seek(0, 2)
+		self.matrix_file.write(embeddings.tobytes())
+		self.node_ids_file.writelines(f"{node_id}\n" for node_id in node_ids)
+		self.node_ids_file.flush()
+		self.rows += len(node_ids)
+		self._write_header(self.rows)
+		self.matrix_file.flush()
+
+	def close(self) -> None:
+		self.matrix_file.close()
+		self.node_ids_file.close()
+
+
+class EmbeddingMatrix:
+	"""
+	Read only view over the matrix parts of a folder.
+
+	The parts are memory mapped, so opening the matrix does not read the vectors,
+	and only the rows that are sliced are loaded from disk.
+	"""
+
+	def __init__(self, directory: Union[Path, str]):
+		self.directory = Path(directory)
+		self.parts: List[np.ndarray] = []
+		# node_id -> (part, row), a node embedded twice keeps the row written last
+		self.rows: Dict[str, Tuple[int, int]] = {}
+		part_node_ids: Dict[str, List[str]] = {}
+		for matrix_path in sorted(self.directory.glob(f"*{MATRIX_SUFFIX}")):
+			node_ids_path = matrix_path.with_suffix(NODE_IDS_SUFFIX)
+			if not node_ids_path.exists():
+				continue
+			matrix = np.load(matrix_path, mmap_mode="r")
+			node_ids = node_ids_path.read_text(encoding="utf-8").splitlines()
+			part_node_ids[matrix_path.stem] = node_ids[: len(matrix)]
+			self.parts.append(matrix)
+		part_indices = {name: index for index, name in enumerate(part_node_ids)}
+		for name, start, end in self._segments(part_node_ids):
+			for row in range(start, end):
+				self.rows[part_node_ids[name][row]] = (part_indices[name], row)
+		logger.info(
+			f"Opened {len(self.rows)} embeddings from {len(self.parts)} parts in {self.directory}"
+		)
+
+	def _segments(
+		self, part_node_ids: Dict[str, List[str]]
+	) -> List[Tuple[str, int, int]]:
+		"""Row ranges of the parts as (part name, first row, end row), in write order."""
+		openings: List[Tuple[str, int]] = []
+		index_path = self.directory.joinpath(PARTS_INDEX)
+		if index_path.exists():
+			for line in index_path.read_text(encoding="utf-8").splitlines():
+				name, _, start = line.partition("\t")
+				if name in part_node_ids and start.isdigit():
+					openings.append((name, int(start)))
+		indexed = {name for name, _ in openings}
+		# parts written before the index existed are older than every indexed part
+		segments = [
+			(name, 0, len(node_ids))
+			for name, node_ids in part_node_ids.items()
+			if name not in indexed
+		]
+		for position, (name, start) in enumerate(openings):
+			next_start: Optional[int] = next(
+				(
+					later_start
+					for later_name, later_start in openings[position + 1 :]
+					if later_name == name
+				),
+				None,
+			)
+			end = len(part_node_ids[name]) if next_start is None else next_start
+			segments.append((name, min(start, end), end))
+		return segments
+
+	def __len__(self) -> int:
+		return len(self.rows)
+
+	def __contains__(self, node_id: str) -> bool:
+		return node_id in self.rows
+
+	def vector(self, node_id: str) -> np.ndarray:
+		"""Embedding of a node, a read only view of the mapped file unless it is stored as float16."""
+		part, row = self.rows[node_id]
+		return np.asarray(self.parts[part][row], dtype=np.float32)
+
+	def assign_embeddings(self, nodes: Sequence[Node]) -> List[Node]:
+		"""
+		Set the embedding of the nodes from the matrix.
+
+		The embeddings are set as float32 arrays, which the milvus and pgvector clients accept as is.
+
+		Raises:
+		    KeyError: If a node has no embedding in the matrix.
+		"""
+		for node in nodes:
+			node.embedding = self.vector(node.node_id)
+		return list(nodes)
+
+	def vectors(self, node_ids: Sequence[str]) -> np.ndarray:
+		"""
+		Embeddings of the nodes as a float32 matrix, in the order of the node_ids.
+
+		Raises:
+		    KeyError: If a node has no embedding in the matrix.
+		"""
+		result = np.empty(
+			(len(node_ids), self.parts[0].shape[1] if self.parts else 0),
+			dtype=np.float32,
+		)
+		for index, node_id in enumerate(node_ids):
+			part, row = self.rows[node_id]
+			result[index] = self.parts[part][row]
+		return result
@@ -0,0 +1,244 @@
+"""Columnar storage of the nodes in Parquet files.
+
+The embeddings are stored as a fixed size list of float32, so a row group maps
+to a contiguous float32 buffer that NumPy reads without copy. The nested fields
+(bbox, elements, document) are kept as JSON strings, the same way they are
+stored in milvus.
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.rag.schemas.document import Node
+from src.shared.logger import setup_logger
+
+logger = setup_logger("node store")
+
+PARQUET_SUFFIX = ".parquet"
+DEFAULT_ROW_GROUP_SIZE = 1024
+JSON_COLUMNS = ("bbox", "elements", "document")
+
+
+def node_schema(vector_dimension: Optional[int]) -> pa.Schema:
+	"""Arrow schema of the node files, the embedding column is a fixed size list when the dimension is known."""
+	embedding_type = (
+		pa.list_(pa.float32(), vector_dimension)
+		if vector_dimension
+		else pa.list_(pa.float32())
+	)
+	return pa.schema(
+		[
+			pa.field("node_id", pa.string(), nullable=False),
+			pa.field("variant", pa.list_(pa.string())),
+			pa.field("tokens", pa.int32()),
+			pa.field("bbox", pa.string()),
+			pa.field("text", pa.string()),
+			pa.field("elements", pa.string()),
+			pa.field("object", pa.string()),
+			pa.field("score", pa.float32()),
+			pa.field("previous_texts", pa.list_(pa.string())),
+			pa.field("next_texts", pa.list_(pa.string())),
+			pa.field("document", pa.string()),
+			pa.field("embedding", embedding_type),
+		]
+	)
+
+
+def nodes_to_table(nodes: Sequence[Node]) -> pa.Table:
+	"""Convert the nodes to an arrow table following `node_schema`."""
+	vector_dimension = next(
+		(len(node.embedding) for node in nodes if node.embedding is not None), None
+	)
+	schema = node_schema(vector_dimension)
+	columns: Dict[str, List[Any]] = {name: [] for name in schema.names}
+	for node in nodes:
+		row = node.model_dump(mode="json", exclude={"embedding"})
+		for name in schema.names:
+			if name == "embedding":
+				continue
+			value = row.get(name)
+			columns[name].append(
+				json.dumps(value)
+				if name in JSON_COLUMNS and value is not None
+				else value
+			)
+	if vector_dimension and all(node.embedding is not None for node in nodes):
+		# build the vectors from one contiguous buffer instead of python lists
+		values = pa.array(
+			np.asarray([node.embedding for node in nodes], dtype=np.float32).ravel()
+		)
+		embeddings = pa.FixedSizeListArray.from_arrays(values, vector_dimension)
+	else:
+		embeddings = pa.array(
+			[node.embedding for node in nodes], type=schema.field("embedding").type
+		)
+	arrays = [
+		embeddings
+		if name == "embedding"
+		else pa.array(columns[name], type=schema.field(name).type)
+		for name in schema.names
+	]
+	return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_nodes(
+	nodes: Sequence[Node],
+	path: Union[Path, str],
+	row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+) -> Path:
+	"""Write the nodes to a Parquet file, one row group every `row_group_size` nodes."""
+	path = Path(path)
+	pq.write_table(
+		nodes_to_table(nodes),
+		path,
+		row_group_size=row_group_size,
+		compression="zstd",
+		# dictionary encoding only pays off on the low cardinality columns
+		use_dictionary=["variant", "object"],
+	)
+	return path
+
+
+def iter_record_batches(
+	path: Union[Path, str],
+	columns: Optional[Sequence[str]] = None,
+	batch_size: int = DEFAULT_ROW_GROUP_SIZE,
+) -> Iterator[pa.RecordBatch]:
+	"""Stream the rows of a node file, reading one row group at a time."""
+	parquet_file = pq.ParquetFile(path)
+	yield from parquet_file.iter_batches(
+		batch_size=batch_size, columns=list(columns) if columns else None
+	)
+
+
+def embedding_matrix(batch: Union[pa.RecordBatch, pa.Table]) -> np.ndarray:
+	"""
+	View the embedding column as a (rows, dimension) float32 matrix without copying it.
+
+	Raises:
+	    ValueError: If the column is not a fixed size list or some nodes have no embedding.
+	"""
+	column = batch.column("embedding")
+	if isinstance(column, pa.ChunkedArray):
+		column = column.combine_chunks()
+	if not pa.types.is_fixed_size_list(column.type):
+		raise ValueError("The embedding column has no fixed dimension")
+	if column.null_count:
+		raise ValueError(f"{column.null_count} nodes have no embedding")
+	values = column.flatten().to_numpy(zero_copy_only=True)
+	return values.reshape(len(column), column.type.list_size)
+
+
+def batch_to_nodes(batch: pa.RecordBatch, trusted: bool = False) -> List[Node]:
+	"""
+	Rebuild the nodes of a record batch, without validating them if `trusted`, see `Node.construct_trusted`.
+
+	When every node has an embedding of the same dimension, the embeddings are set as
+	read only float32 rows of `embedding_matrix`, views of the record batch that are
+	never turned into python lists.
+	"""
+	column = batch.column("embedding")
+	embeddings = None
+	if pa.types.is_fixed_size_list(column.type) and not column.null_count:
+		embeddings = embedding_matrix(batch)
+		batch = batch.select(
+			[name for name in batch.schema.names if name != "embedding"]
+		)
+	rows = batch.to_pylist()
+	for row in rows:
+		for name in JSON_COLUMNS:
+			if isinstance(row.get(name), str):
+				row[name] = json.loads(row[name])
+	if trusted:
+		nodes = [Node.construct_trusted(row) for row in rows]
+	else:
+		nodes = [Node.model_validate(row) for row in rows]
+	if embeddings is not None:
+		for node, embedding in zip(nodes, embeddings):
+			node.embedding = embedding
+	return nodes
+
+
+def iter_nodes(
+	path: Union[Path, str],
+	batch_size: int = DEFAULT_ROW_GROUP_SIZE,
+	trusted: bool = False,
+) -> Iterator[List[Node]]:
+	"""Stream the nodes of a node file, one batch of nodes per row group."""
+	for batch in iter_record_batches(path, batch_size=batch_size):
+		yield batch_to_nodes(batch, trusted=trusted)
+
+
+def read_nodes(path: Union[Path, str], trusted: bool = False) -> List[Node]:
+	"""Load every node of a node file."""
+	return [node for nodes in iter_nodes(path, trusted=trusted) for node in nodes]
+
+
+def convert_json_to_parquet(
+	input_path: Union[Path, str],
+	output_path: Union[Path, str],
+	glob: str = "**/*.json",
+	row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+) -> List[str]:
+	"""
+	Convert every JSON node file of the input folder to a Parquet file in the output folder.
+
+	Returns:
+	    List[str]: The JSON files that could not be converted.
+	"""
+	# imported here, the IOManager imports this module for its parquet format
+	from src.rag.components.shared.io import IOManager
+
+	io_manager = IOManager(
+		input_document_path=Path(input_path), output_path=output_path, glob=glob
+	)
+	for document_path in io_manager.all_documents:
+		nodes = io_manager.load_nodes_from_path(document_path)
+		if not nodes:
+			continue
+		relative_path = document_path.relative_to(io_manager.input_document_path)
+		parquet_path = io_manager.output_document_path.joinpath(
+			relative_path
+		).with_suffix(PARQUET_SUFFIX)
+		parquet_path.parent.mkdir(parents=True, exist_ok=True)
+		write_nodes(nodes, parquet_path, row_group_size=row_group_size)
+		logger.info(
+			f"Converted {len(nodes)} nodes of {document_path} to {parquet_path}"
+		)
+	return io_manager.failed_documents
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Convert the JSON node files to the Parquet node store."
+	)
+	parser.add_argument(
+		"--input_path",
+		type=Path,
+		default=Path.cwd().joinpath("datasets", "parsed_documents_with_embeddings"),
+		help="Folder of the JSON node files.",
+	)
+	parser.add_argument(
+		"--output_path",
+		type=Path,
+		default=Path.cwd().joinpath("datasets", "parsed_documents_parquet"),
+		help="Folder receiving the Parquet node files.",
+	)
+	parser.add_argument(
+		"--row_group_size",
+		type=int,
+		default=DEFAULT_ROW_GROUP_SIZE,
+		help="Number of nodes per row group.",
+	)
+	args = parser.parse_args()
+	failed_documents = convert_json_to_parquet(
+		args.input_path, args.output_path, row_group_size=args.row_group_size
+	)
+	if failed_documents:
+		logger.warning(f"{len(failed_documents)} files could not be converted")
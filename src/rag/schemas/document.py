@@ -2,7 +2,7 @@ import json
 import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterator, List, Literal, Optional
+from typing import Any, Dict, Iterator, List, Literal, Optional, Sequence
 
 from docling.datamodel.document import DoclingDocument
 from docling_core.transforms.chunker import BaseChunk
@@ -107,11 +107,43 @@ class Node(BaseModel):
 		model_keys = model_keys - {"embedding"}
 		return list(model_keys)
 
+	@classmethod
+	def construct_trusted(cls, data: Dict[str, Any]) -> "Node":
+		"""
+		Build a node from data written by `model_dump`, without validating it.
+
+		Only for files produced by this pipeline: the fields are taken as they are and the
+		nested bbox and document are built the same way. The dates of the document are
+		parsed from their ISO strings, the serializers of `Document` expect datetimes.
+		"""
+		data = dict(data)
+		data["bbox"] = [BoundingBox.model_construct(**bbox) for bbox in data["bbox"]]
+		if data.get("elements") is not None:
+			data["elements"] = tuple(data["elements"])
+		document = dict(data["document"])
+		for key in ("last_modified_date", "last_accessed_date", "creation_date"):
+			if isinstance(document[key], str):
+				document[key] = datetime.fromisoformat(document[key])
+		data["document"] = Document.model_construct(**document)
+		return cls.model_construct(**data)
+
+	@staticmethod
+	def decode_milvus_entity(entity: Dict[str, Any]) -> Dict[str, Any]:
+		"""Decode the fields stored as JSON strings in milvus (bbox, document)."""
+		decoded = dict(entity)
+		for key in ("bbox", "document"):
+			if isinstance(decoded.get(key), str):
+				decoded[key] = json.loads(decoded[key])
+		return decoded
+
 	@staticmethod
-	def from_milvus_entity(entity: Dict[str, Any]) -> "Node":
+	def from_milvus_entity(
+		entity: Dict[str, Any], score: Optional[float] = None
+	) -> "Node":
 		"""Create a DocNode instance from a milvus entity."""
-		bbox = [BoundingBox(**bbox) for bbox in entity.get("bbox", [])]
-		elements = tuple(ImageElement(**el) for el in entity.get("elements", []))
+		entity = Node.decode_milvus_entity(entity)
+		bbox = [BoundingBox(**bbox) for bbox in entity.get("bbox") or []]
+		elements = tuple(ImageElement(**el) for el in entity.get("elements") or [])
 		return Node(
 			node_id=entity["node_id"],
 			variant=entity["variant"],
@@ -119,9 +151,25 @@ class Node(BaseModel):
 			bbox=bbox,
 			text=entity["text"],
 			elements=elements,
+			score=entity.get("score", 0.0) if score is None else score,
+			previous_texts=entity.get("previous_texts"),
+			next_texts=entity.get("next_texts"),
+			document=entity["document"],
 			metadata=entity.get("metadata"),
 		)
 
+	@staticmethod
+	def project_milvus_entity(
+		entity: Dict[str, Any], fields: Sequence[str], score: float
+	) -> Dict[str, Any]:
+		"""Keep only the requested fields of a milvus entity, without building a Node."""
+		entity = Node.decode_milvus_entity(entity)
+		projection = {"node_id": entity["node_id"], "score": score}
+		for field in fields:
+			if field in entity and field not in projection:
+				projection[field] = entity[field]
+		return projection
+
 	@staticmethod
 	def to_sql_schema(embedding_dimension: int, table_prefix: str) -> Dict[str, str]:
 		return {
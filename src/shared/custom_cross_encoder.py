@@ -1,14 +1,37 @@
 import logging
-from typing import Dict, Optional
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
 from sentence_transformers import CrossEncoder
 from sentence_transformers.util import fullname, get_device_name, import_from_string
 from torch import nn
 from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
 
+from src.shared.rerank_cache import RerankScoreCache
+
 logger = logging.getLogger(__name__)
 
+# cross encoders are trained on 512 tokens, longer pairs are truncated
+DEFAULT_MAX_LENGTH = 512
+ONNX_OPSET = 14
+DEFAULT_ONNX_DIRECTORY = Path.cwd().joinpath("models_repository", "reranker")
+
+
+class LogitsOnly(nn.Module):
+	"""Sequence classification model taking its inputs by position and returning the logits, for the onnx export."""
+
+	def __init__(self, model: nn.Module, input_names: Sequence[str]):
+		super().__init__()
+		self.model = model
+		self.input_names = list(input_names)
+
+	def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+		return self.model(
+			**dict(zip(self.input_names, inputs)), return_dict=True
+		).logits
+
 
 class CustomCrossEncoder(CrossEncoder):
 	def __init__(
@@ -25,7 +48,30 @@ class CustomCrossEncoder(CrossEncoder):
 		default_activation_function=None,
 		classifier_dropout: float = None,
 		config_kwargs: Dict = None,
+		backend: str = "torch",
+		onnx_directory: Optional[Union[Path, str]] = None,
+		quantize: bool = False,
+		intra_op_num_threads: Optional[int] = None,
+		score_cache: Optional[RerankScoreCache] = None,
 	) -> None:
+		"""
+		The onnx backend exports the model to onnx on first use, optionally applies
+		dynamic int8 quantization, and runs it with onnxruntime on the cpu.
+
+		Args:
+		    backend: "torch" or "onnx"
+		    onnx_directory: Where the exported onnx models are stored
+		    quantize: Whether the onnx model is quantized to int8
+		    intra_op_num_threads: Number of threads used by onnxruntime inside an operator
+		    score_cache: Optional cache of the scores, only unseen pairs are sent to the model
+		"""
+		if backend not in ("torch", "onnx"):
+			raise ValueError(f"Unknown backend {backend!r}, expected 'torch' or 'onnx'")
+		self.model_name = model_name
+		self.revision = revision
+		self.backend = backend
+		self.quantize = quantize
+		self.score_cache = score_cache
 		if tokenizer_args is None:
 			tokenizer_args = {}
 		if automodel_args is None:
@@ -72,7 +118,10 @@ class CustomCrossEncoder(CrossEncoder):
 			trust_remote_code=trust_remote_code,
 			**tokenizer_args,
 		)
-		self.max_length = max_length
+		# make the truncation explicit instead of relying on the tokenizer default
+		self.max_length = min(
+			max_length or DEFAULT_MAX_LENGTH, self.tokenizer.model_max_length
+		)
 
 		if device is None:
 			device = get_device_name()
@@ -103,3 +152,263 @@ class CustomCrossEncoder(CrossEncoder):
 			self.default_activation_function = (
 				nn.Sigmoid() if self.config.num_labels == 1 else nn.Identity()
 			)
+
+		self.onnx_session = None
+		if backend == "onnx":
+			self.onnx_session = self.create_onnx_session(
+				Path(onnx_directory or DEFAULT_ONNX_DIRECTORY),
+				quantize=quantize,
+				intra_op_num_threads=intra_op_num_threads,
+			)
+
+	def export_to_onnx(self, onnx_directory: Path, quantize: bool = False) -> Path:
+		"""
+		Export the model to onnx, reusing a previous export when it exists.
+
+		Returns:
+		    The path of the onnx model, quantized or not
+		"""
+		model_directory = onnx_directory.joinpath(
+			self.model_name.replace("/", "_"), self.revision or "main"
+		)
+		model_directory.mkdir(parents=True, exist_ok=True)
+		onnx_path = model_directory.joinpath("model.onnx")
+		if not onnx_path.exists():
+			logger.info(f"Exporting {self.model_name} to {onnx_path}")
+			dummy_features = self.tokenizer(["query"], ["passage"], return_tensors="pt")
+			input_names = [
+				name
+				for name in self.tokenizer.model_input_names
+				if name in dummy_features
+			]
+			self.model.eval()
+			with torch.no_grad():
+				torch.onnx.export(
+					LogitsOnly(self.model.to("cpu"), input_names),
+					tuple(dummy_features[name] for name in input_names),
+					str(onnx_path),
+					input_names=input_names,
+					output_names=["logits"],
+					dynamic_axes={
+						**{name: {0: "batch", 1: "sequence"} for name in input_names},
+						"logits": {0: "batch"},
+					},
+					opset_version=ONNX_OPSET,
+				)
+		if not quantize:
+			return onnx_path
+
+		quantized_path = model_directory.joinpath("model.int8.onnx")
+		if not quantized_path.exists():
+			from onnxruntime.quantization import QuantType, quantize_dynamic
+
+			logger.info(f"Quantizing {onnx_path} to {quantized_path}")
+			quantize_dynamic(
+				model_input=str(onnx_path),
+				model_output=str(quantized_path),
+				weight_type=QuantType.QInt8,
+			)
+		return quantized_path
+
+	def create_onnx_session(
+		self,
+		onnx_directory: Path,
+		quantize: bool = False,
+		intra_op_num_threads: Optional[int] = None,
+	):
+		"""Export the model if needed and open an onnxruntime cpu session on it."""
+		import onnxruntime
+
+		onnx_path = self.export_to_onnx(onnx_directory, quantize=quantize)
+		session_options = onnxruntime.SessionOptions()
+		session_options.graph_optimization_level = (
+			onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+		)
+		if intra_op_num_threads:
+			session_options.intra_op_num_threads = intra_op_num_threads
+		logger.info(f"Loading onnx reranker from {onnx_path}")
+		return onnxruntime.InferenceSession(
+			str(onnx_path),
+			sess_options=session_options,
+			providers=["CPUExecutionProvider"],
+		)
+
+	def tokenize_pairs(self, pairs: Sequence[Tuple[str, str]]) -> Dict[str, List]:
+		"""Tokenize the (query, passage) pairs without padding."""
+		return self.tokenizer(
+			[pair[0] for pair in pairs],
+			[pair[1] for pair in pairs],
+			truncation="longest_first",
+			max_length=self.max_length,
+			padding=False,
+		)
+
+	def score_pairs(
+		self,
+		pairs: Sequence[Tuple[str, str]],
+		batch_size: int = 16,
+		backend: Optional[str] = None,
+	) -> np.ndarray:
+		"""
+		Score the (query, passage) pairs, batching pairs of similar length together.
+
+		The pairs are sorted by token length and each batch is only padded to its
+		longest pair, so short passages do not pay for the long ones.
+
+		Args:
+		    pairs: The (query, passage) pairs to score
+		    batch_size: Number of pairs per forward pass
+		    backend: "torch" or "onnx", the backend chosen at init by default
+
+		Returns:
+		    The scores, in the order of the pairs
+		"""
+		if not pairs:
+			return np.array([], dtype=np.float32)
+		features = self.tokenize_pairs(pairs)
+		lengths = [len(input_ids) for input_ids in features["input_ids"]]
+		sorted_indices = np.argsort(lengths, kind="stable")
+		scores = np.empty(len(pairs), dtype=np.float32)
+
+		if backend is None:
+			backend = self.backend
+		if backend == "torch":
+			self.model.to(self._target_device)
+			self.model.eval()
+		with torch.inference_mode():
+			for start in range(0, len(sorted_indices), batch_size):
+				bucket = sorted_indices[start : start + batch_size]
+				bucket_features = self.tokenizer.pad(
+					{
+						name: [values[index] for index in bucket]
+						for name, values in features.items()
+					},
+					padding="longest",
+					return_tensors="pt",
+				)
+				logits = self.default_activation_function(
+					self._forward(bucket_features, backend)
+				)
+				if logits.shape[1] == 1:
+					logits = logits[:, 0]
+				scores[bucket] = logits.float().cpu().numpy()
+		return scores
+
+	def _forward(self, features, backend: str) -> torch.Tensor:
+		"""Run the model on a padded batch and return the raw logits."""
+		if backend == "onnx":
+			if self.onnx_session is None:
+				raise ValueError("The onnx backend was not initialized.")
+			input_names = {
+				model_input.name for model_input in self.onnx_session.get_inputs()
+			}
+			logits = self.onnx_session.run(
+				["logits"],
+				{
+					name: tensor.numpy().astype(np.int64)
+					for name, tensor in features.items()
+					if name in input_names
+				},
+			)[0]
+			return torch.from_numpy(logits)
+		features = features.to(self._target_device)
+		return self.model(**features, return_dict=True).logits
+
+	def compare_backends(
+		self, pairs: Sequence[Tuple[str, str]], tolerance: float = 1e-3
+	) -> float:
+		"""
+		Check that the onnx scores stay within the tolerance of the torch scores.
+
+		Quantized models need a looser tolerance than plain onnx exports.
+
+		Returns:
+		    The largest absolute difference between the two backends
+		"""
+		torch_scores = self.score_pairs(pairs, backend="torch")
+		onnx_scores = self.score_pairs(pairs, backend="onnx")
+		max_difference = float(np.max(np.abs(torch_scores - onnx_scores)))
+		if max_difference > tolerance:
+			raise ValueError(
+				f"The onnx scores differ from the torch scores by {max_difference}, above the tolerance {tolerance}"
+			)
+		return max_difference
+
+	def rank_passages(
+		self,
+		query: str,
+		passages: Sequence[str],
+		top_k: Optional[int] = None,
+		batch_size: int = 16,
+		passage_ids: Optional[Sequence[str]] = None,
+	) -> List[Tuple[int, float]]:
+		"""
+		Rank the passages against the query.
+
+		Every passage is scored, a cross encoder score gives no bound on the scores
+		of the other passages. `top_k` only limits the returned pairs, which are
+		selected with a partial sort.
+
+		Args:
+		    top_k: Number of best passages to return, all of them by default
+		    passage_ids: Optional stable ids of the passages (node ids), used as score cache keys
+		        instead of the content hashes
+
+		Returns:
+		    The (passage index, score) pairs of the top_k best passages, best first
+		"""
+		scores = self.score_passages(query, passages, batch_size, passage_ids)
+		if top_k is not None and top_k < len(scores):
+			# select the top k before sorting them
+			candidates = np.argpartition(-scores, top_k)[:top_k]
+		else:
+			candidates = np.arange(len(scores))
+		ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+		return [(int(index), float(scores[index])) for index in ranked]
+
+	@property
+	def model_revision(self) -> str:
+		"""Identity of the scoring model, scores of different revisions or backends are not shared."""
+		backend = f"{self.backend}-int8" if self.quantize else self.backend
+		return (
+			f"{self.model_name}@{self.revision or 'main'}:{backend}:{self.max_length}"
+		)
+
+	def score_passages(
+		self,
+		query: str,
+		passages: Sequence[str],
+		batch_size: int = 16,
+		passage_ids: Optional[Sequence[str]] = None,
+	) -> np.ndarray:
+		"""Score the passages against the query, only scoring with the model the pairs missing from the cache."""
+		if self.score_cache is None:
+			return self.score_pairs(
+				[(query, passage) for passage in passages], batch_size=batch_size
+			)
+		if passage_ids is None:
+			passage_ids = [None] * len(passages)
+		keys = [
+			RerankScoreCache.make_key(self.model_revision, query, passage, passage_id)
+			for passage, passage_id in zip(passages, passage_ids, strict=True)
+		]
+		cached_scores = self.score_cache.get_many(keys)
+		missing_indices = [
+			index for index, key in enumerate(keys) if key not in cached_scores
+		]
+		scores = np.array(
+			[cached_scores.get(key, np.nan) for key in keys], dtype=np.float32
+		)
+		if missing_indices:
+			missing_scores = self.score_pairs(
+				[(query, passages[index]) for index in missing_indices],
+				batch_size=batch_size,
+			)
+			scores[missing_indices] = missing_scores
+			self.score_cache.set_many(
+				{
+					keys[index]: float(score)
+					for index, score in zip(missing_indices, missing_scores)
+				}
+			)
+		return scores
@@ -1,3 +1,4 @@
+import contextlib
 from collections.abc import Generator
 from os import getenv
 from typing import Dict, List, Optional
@@ -6,6 +7,7 @@ from urllib.parse import quote
 from dotenv import load_dotenv
 from psycopg2 import connect
 from psycopg2.extras import NamedTupleCursor
+from psycopg2.pool import ThreadedConnectionPool
 from sqlalchemy.engine import Connection
 
 load_dotenv()
@@ -35,6 +37,27 @@ def generate_database_connection(
 	return database_connection
 
 
+def generate_connection_pool(
+	max_connections: int,
+	min_connections: int = 1,
+	database_crendentials: Optional[Dict] = default_database_crendentials,
+) -> ThreadedConnectionPool:
+	"""Create a thread safe pool of connections, one connection per concurrent query."""
+	return ThreadedConnectionPool(
+		min_connections, max_connections, **database_crendentials
+	)
+
+
+@contextlib.contextmanager
+def pooled_connection(connection_pool: ThreadedConnectionPool):
+	"""Borrow a connection from the pool and give it back once done."""
+	connection = connection_pool.getconn()
+	try:
+		yield connection
+	finally:
+		connection_pool.putconn(connection)
+
+
 def execute_query(
 	database_connection, query, params=None
 ) -> Generator[List[NamedTupleCursor]]:
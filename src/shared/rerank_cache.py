@@ -0,0 +1,211 @@
+import hashlib
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Union
+
+from psycopg2 import sql
+
+from src.shared.logger import setup_logger
+from src.shared.text import text_hash
+
+logger = setup_logger("rerank score cache")
+
+
+class ScoreStore(ABC):
+	"""Persistent tier of the rerank score cache."""
+
+	@abstractmethod
+	def get_many(self, keys: Sequence[str]) -> Dict[str, float]:
+		"""
+		Return the stored scores of the keys, missing keys are left out.
+
+		Args:
+		    keys (Sequence[str]): The cache keys.
+		"""
+		pass
+
+	@abstractmethod
+	def set_many(self, scores: Dict[str, float]) -> None:
+		"""
+		Store the scores.
+
+		Args:
+		    scores (Dict[str, float]): The scores keyed by cache key.
+		"""
+		pass
+
+	def close(self) -> None:
+		"""Release the resources held by the store."""
+		pass
+
+
+class SQLiteScoreStore(ScoreStore):
+	"""Local disk backed store of the rerank scores."""
+
+	def __init__(self, database_path: Union[Path, str]):
+		self.database_path = Path(database_path)
+		self.database_path.parent.mkdir(parents=True, exist_ok=True)
+		self._lock = threading.Lock()
+		self.connection = sqlite3.connect(
+			str(self.database_path), check_same_thread=False
+		)
+		with self._lock, self.connection:
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute(
+				"CREATE TABLE IF NOT EXISTS rerank_scores (key TEXT PRIMARY KEY, score REAL NOT NULL)"
+			)
+		logger.info(f"SQLite score store opened at {self.database_path}")
+
+	def get_many(self, keys: Sequence[str]) -> Dict[str, float]:
+		if not keys:
+			return {}
+		placeholders = ", ".join("?" * len(keys))
+		with self._lock:
+			rows = self.connection.execute(
+				f"SELECT key, score FROM rerank_scores WHERE key IN ({placeholders})",
+				list(keys),
+			).fetchall()
+		return dict(rows)
+
+	def set_many(self, scores: Dict[str, float]) -> None:
+		with self._lock, self.connection:
+			self.connection.executemany(
+				"INSERT OR REPLACE INTO rerank_scores (key, score) VALUES (?, ?)",
+				list(scores.items()),
+			)
+
+	def close(self) -> None:
+		self.connection.close()
+
+
+class PostgresScoreStore(ScoreStore):
+	"""Store of the rerank scores shared by every pod through postgres."""
+
+	def __init__(self, database_connection, table_name: str = "rerank_scores"):
+		"""
+		Args:
+		    database_connection: A psycopg2 connection, see `src.shared.database.generate_database_connection`
+		    table_name: Name of the table holding the scores
+		"""
+		self.connection = database_connection
+		self.table = sql.Identifier(table_name)
+		self._lock = threading.Lock()
+		with self._lock, self.connection, self.connection.cursor() as cursor:
+			cursor.execute(
+				sql.SQL(
+					"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, score REAL NOT NULL)"
+				).format(table=self.table)
+			)
+
+	def get_many(self, keys: Sequence[str]) -> Dict[str, float]:
+		if not keys:
+			return {}
+		query = sql.SQL("SELECT key, score FROM {table} WHERE key = ANY(%s)").format(
+			table=self.table
+		)
+		with self._lock, self.connection, self.connection.cursor() as cursor:
+			cursor.execute(query, (list(keys),))
+			return dict(cursor.fetchall())
+
+	def set_many(self, scores: Dict[str, float]) -> None:
+		if not scores:
+			return
+		query = sql.SQL(
+			"INSERT INTO {table} (key, score) VALUES (%s, %s) "
+			"ON CONFLICT (key) DO UPDATE SET score = EXCLUDED.score"
+		).format(table=self.table)
+		with self._lock, self.connection, self.connection.cursor() as cursor:
+			cursor.executemany(query, list(scores.items()))
+
+	def close(self) -> None:
+		self.connection.close()
+
+
+class RerankScoreCache:
+	"""
+	Thread safe LRU cache of cross encoder scores.
+
+	The keys combine the model revision, the hash of the normalized query and the
+	passage identity (its node_id when known, else the hash of its content), so
+	only the pairs never seen before have to go through the model.
+	"""
+
+	def __init__(self, max_entries: int = 100_000, store: Optional[ScoreStore] = None):
+		"""
+		Args:
+		    max_entries: Maximum number of scores kept in memory
+		    store: Optional persistent tier consulted on in-memory misses
+		"""
+		self.max_entries = max_entries
+		self.store = store
+		self._scores: OrderedDict[str, float] = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.store_hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def make_key(
+		model_revision: str,
+		query: str,
+		passage: str,
+		passage_id: Optional[str] = None,
+	) -> str:
+		"""Build the cache key of a (query, passage) pair."""
+		passage_key = (
+			f"id:{passage_id}" if passage_id is not None else text_hash(passage)
+		)
+		raw_key = "\x1f".join([model_revision, text_hash(query), passage_key])
+		return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+	def get_many(self, keys: Sequence[str]) -> Dict[str, float]:
+		"""Return the cached scores of the keys, missing keys are left out."""
+		found = {}
+		with self._lock:
+			for key in keys:
+				if key in self._scores:
+					self._scores.move_to_end(key)
+					found[key] = self._scores[key]
+			self.hits += len(found)
+		missing = [key for key in keys if key not in found]
+		if missing and self.store is not None:
+			stored = self.store.get_many(missing)
+			with self._lock:
+				self.store_hits += len(stored)
+				for key, score in stored.items():
+					self._put(key, score)
+			found.update(stored)
+		with self._lock:
+			self.misses += len(keys) - len(found)
+		return found
+
+	def set_many(self, scores: Dict[str, float]) -> None:
+		"""Cache the scores in memory and in the persistent tier."""
+		with self._lock:
+			for key, score in scores.items():
+				self._put(key, score)
+		if self.store is not None:
+			self.store.set_many(scores)
+
+	@property
+	def stats(self) -> Dict[str, float]:
+		with self._lock:
+			lookups = self.hits + self.store_hits + self.misses
+			return {
+				"hits": self.hits,
+				"store_hits": self.store_hits,
+				"misses": self.misses,
+				"hit_ratio": (self.hits + self.store_hits) / lookups
+				if lookups
+				else 0.0,
+				"entries": len(self._scores),
+			}
+
+	def _put(self, key: str, score: float) -> None:
+		self._scores[key] = float(score)
+		self._scores.move_to_end(key)
+		while len(self._scores) > self.max_entries:
+			self._scores.popitem(last=False)
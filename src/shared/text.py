@@ -0,0 +1,16 @@
+import hashlib
+import re
+from unicodedata import normalize as unicode_normalize
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+	"""Normalize a text so that trivially different queries share a cache entry."""
+	text = unicode_normalize("NFC", text)
+	return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def text_hash(text: str) -> str:
+	"""Stable hash of the normalized text."""
+	return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
@@ -0,0 +1,37 @@
+import os
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def postgres_client():
+	"""
+	Client on a throw-away namespace of the database of POSTGRES_TEST_URI.
+
+	The database needs the vchord extension, the tests are skipped when the variable is not set.
+	"""
+	connection_uri = os.getenv("POSTGRES_TEST_URI")
+	if not connection_uri:
+		pytest.skip("POSTGRES_TEST_URI is not set")
+	from psycopg import connect, sql
+
+	from src.rag.components.shared.databases.postgres import PostgresVectorDBClient
+
+	connection = connect(conninfo=connection_uri, autocommit=True)
+	client = PostgresVectorDBClient(
+		namespace=f"test_{uuid.uuid4().hex[:8]}", connection=connection
+	)
+	yield client
+	with connection.cursor() as cursor:
+		cursor.execute(
+			"SELECT tablename FROM pg_tables WHERE tablename LIKE %s",
+			(f"{client.namespace}%",),
+		)
+		for (table_name,) in cursor.fetchall():
+			cursor.execute(
+				sql.SQL("DROP TABLE IF EXISTS {} CASCADE").format(
+					sql.Identifier(table_name)
+				)
+			)
+	client.close()
@@ -0,0 +1,76 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("psycopg2")
+
+from src.shared.custom_cross_encoder import CustomCrossEncoder  # noqa: E402
+
+VOCABULARY = [
+	"[PAD]",
+	"[UNK]",
+	"[CLS]",
+	"[SEP]",
+	"[MASK]",
+	"query",
+	"passage",
+	"a",
+	"b",
+]
+PAIRS = [("query", "passage a"), ("query a b", "passage"), ("query", "a b a b passage")]
+
+
+@pytest.fixture(scope="module")
+def cross_encoder(tmp_path_factory):
+	# a tiny randomly initialized model, saved locally so nothing is downloaded
+	model_directory = tmp_path_factory.mktemp("tiny_cross_encoder")
+	vocabulary_path = model_directory.joinpath("vocab.txt")
+	vocabulary_path.write_text("\n".join(VOCABULARY))
+	transformers.BertTokenizerFast(vocab_file=str(vocabulary_path)).save_pretrained(
+		model_directory
+	)
+	config = transformers.BertConfig(
+		vocab_size=len(VOCABULARY),
+		hidden_size=16,
+		num_hidden_layers=1,
+		num_attention_heads=2,
+		intermediate_size=32,
+		max_position_embeddings=64,
+		num_labels=1,
+		architectures=["BertForSequenceClassification"],
+	)
+	torch.manual_seed(0)
+	transformers.BertForSequenceClassification(config).save_pretrained(model_directory)
+	return CustomCrossEncoder(
+		str(model_directory),
+		max_length=64,
+		device="cpu",
+		local_files_only=True,
+		backend="onnx",
+		onnx_directory=tmp_path_factory.mktemp("onnx"),
+	)
+
+
+def test_compare_backends_accepts_the_onnx_export(cross_encoder):
+	assert cross_encoder.compare_backends(PAIRS, tolerance=1e-4) <= 1e-4
+
+
+def test_compare_backends_rejects_scores_above_the_tolerance(
+	cross_encoder, monkeypatch
+):
+	score_pairs = cross_encoder.score_pairs
+
+	def drifting_score_pairs(pairs, backend=None):
+		scores = score_pairs(pairs, backend=backend)
+		return scores + 0.01 if backend == "onnx" else scores
+
+	monkeypatch.setattr(cross_encoder, "score_pairs", drifting_score_pairs)
+	with pytest.raises(ValueError, match="above the tolerance"):
+		cross_encoder.compare_backends(PAIRS, tolerance=1e-3)
+	assert cross_encoder.compare_backends(PAIRS, tolerance=0.02) == pytest.approx(
+		0.01, abs=1e-4
+	)
@@ -0,0 +1,55 @@
+import json
+import warnings
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("docling")
+pytest.importorskip("openparse")
+
+from src.rag.schemas.document import BoundingBox, Document, Node  # noqa: E402
+
+
+def make_node() -> Node:
+	document = Document(
+		file_path="/data/report.pdf",
+		filename="report.pdf",
+		num_pages=3,
+		coordinate_system="BOTTOM-LEFT",
+		last_modified_date=datetime.fromtimestamp(1_700_000_000).isoformat(),
+		last_accessed_date=datetime.fromtimestamp(1_700_000_100).isoformat(),
+		creation_date=datetime.fromtimestamp(1_690_000_000).isoformat(),
+		file_size=1024,
+	)
+	return Node(
+		node_id="node-1",
+		variant=["TEXT"],
+		tokens=4,
+		bbox=[
+			BoundingBox(
+				page=1, page_height=842.0, page_width=595.0, x0=0, y0=0, x1=10, y1=10
+			)
+		],
+		text="some text",
+		embedding=[0.1, 0.2, 0.3],
+		previous_texts=["previous text"],
+		document=document,
+	)
+
+
+def test_trusted_node_matches_the_validated_node():
+	node = make_node()
+	# the files written by the pipeline hold the json dump of the nodes
+	data = json.loads(node.model_dump_json())
+
+	trusted = Node.construct_trusted(data)
+
+	assert trusted.document.last_modified_date == node.document.last_modified_date
+	with warnings.catch_warnings():
+		# pydantic warns when a field does not match its serializer
+		warnings.simplefilter("error")
+		trusted_entity = trusted.to_milvus_entity()
+		trusted_row = trusted.to_sql_insert()
+		trusted.model_dump()
+	assert trusted_entity == node.to_milvus_entity()
+	assert trusted_row == node.to_sql_insert()
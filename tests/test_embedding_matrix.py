@@ -0,0 +1,30 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("docling")
+pytest.importorskip("openparse")
+
+from src.rag.components.shared.embedding_matrix import (  # noqa: E402
+	EmbeddingMatrix,
+	EmbeddingMatrixWriter,
+)
+
+
+def write_part(directory, part_name, node_ids, value):
+	writer = EmbeddingMatrixWriter(directory, 2, part_name=part_name)
+	writer.append(node_ids, np.full((len(node_ids), 2), value, dtype=np.float32))
+	writer.close()
+
+
+def test_the_latest_written_row_wins_whatever_the_part_names(tmp_path):
+	# "embeddings_<run>" sorts after "embeddings" but is written in between
+	write_part(tmp_path, "embeddings", ["a", "b"], 1.0)
+	write_part(tmp_path, "embeddings_20250101T000000_0000", ["a", "c"], 2.0)
+	write_part(tmp_path, "embeddings", ["c"], 3.0)
+
+	matrix = EmbeddingMatrix(tmp_path)
+
+	assert len(matrix) == 3
+	assert matrix.vector("a").tolist() == [2.0, 2.0]
+	assert matrix.vector("b").tolist() == [1.0, 1.0]
+	assert matrix.vector("c").tolist() == [3.0, 3.0]
@@ -0,0 +1,157 @@
+from datetime import datetime
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("psycopg")
+pytest.importorskip("pgvector")
+pytest.importorskip("docling")
+pytest.importorskip("openparse")
+
+from psycopg import adapters, postgres  # noqa: E402
+from psycopg.pq import Format  # noqa: E402
+
+from src.rag.components.shared.databases.postgres import (  # noqa: E402
+	PostgresVectorDBClient,
+)
+from src.rag.schemas.document import Document  # noqa: E402
+
+TIMESTAMP_COLUMNS = ("last_modified_date", "last_accessed_date", "creation_date")
+
+
+def make_document() -> Document:
+	# naive local dates, the same way Document.from_docling_document builds them
+	return Document(
+		file_path="/data/report.pdf",
+		filename="report.pdf",
+		num_pages=3,
+		coordinate_system="BOTTOM-LEFT",
+		last_modified_date=datetime.fromtimestamp(1_700_000_000).isoformat(),
+		last_accessed_date=datetime.fromtimestamp(1_700_000_100).isoformat(),
+		creation_date=datetime.fromtimestamp(1_690_000_000).isoformat(),
+		file_size=1024,
+	)
+
+
+@pytest.mark.parametrize("mode", ["python", "json"])
+def test_copy_value_dumps_document_dates_in_binary(mode):
+	# json mode keeps the ISO strings, as the rows of a json dump
+	row = make_document().model_dump(mode=mode)
+	dumper = adapters.get_dumper_by_oid(
+		postgres.types["timestamptz"].oid, Format.BINARY
+	)(datetime)
+	for column in TIMESTAMP_COLUMNS:
+		value = PostgresVectorDBClient._copy_value(row[column], "timestamptz")
+		assert value.tzinfo is not None
+		assert value == datetime.fromisoformat(str(row[column])).astimezone()
+		dumper.dump(value)
+
+
+def test_bulk_copy_round_trips_a_document(postgres_client):
+	document = make_document()
+	postgres_client.create_table(name="documents", schema=Document.to_sql_schema())
+
+	inserted = postgres_client.bulk_copy(
+		table_name="documents",
+		data=[document.model_dump()],
+		returning=["doc_id"],
+	)
+	# the conflicting row of a second COPY is skipped
+	inserted_again = postgres_client.bulk_copy(
+		table_name="documents",
+		data=[document.model_dump(mode="json")],
+		returning=["doc_id"],
+	)
+
+	assert inserted == [(document.doc_id,)]
+	assert inserted_again == []
+	with postgres_client.connection.cursor() as cursor:
+		cursor.execute(
+			f"SELECT {', '.join(TIMESTAMP_COLUMNS)}, file_size "
+			f"FROM {postgres_client.namespace}_documents"
+		)
+		row = cursor.fetchone()
+	assert row[:3] == tuple(
+		getattr(document, column).astimezone() for column in TIMESTAMP_COLUMNS
+	)
+	assert row[3] == document.file_size
+
+
+class RecordingCursor:
+	def __init__(self):
+		self.executed = []
+
+	def execute(self, query, params=None):
+		self.executed.append((query, params))
+
+
+def test_set_probes_passes_the_probe_as_a_value():
+	# SET rejects the $1 server-side parameters psycopg sends for %s
+	cursor = RecordingCursor()
+	PostgresVectorDBClient._set_probes(cursor, 12)
+	[(query, params)] = cursor.executed
+	assert query.startswith("SELECT set_config('vchordrq.probes'")
+	assert params == ("12",)
+
+
+def test_search_many_by_vector_groups_results_per_query(postgres_client):
+	postgres_client.create_table(
+		name="nodes", schema={"node_id": "TEXT PRIMARY KEY", "embedding": "vector(3)"}
+	)
+	postgres_client.bulk_copy(
+		table_name="nodes",
+		data=[
+			{"node_id": "x", "embedding": [1.0, 0.0, 0.0]},
+			{"node_id": "y", "embedding": [0.0, 1.0, 0.0]},
+			{"node_id": "z", "embedding": [0.0, 0.0, 1.0]},
+		],
+	)
+
+	results = postgres_client.search_many_by_vector(
+		table_name="nodes",
+		vector_column="embedding",
+		query_vectors=np.array([[0.0, 0.9, 0.1], [1.0, 0.1, 0.0]], dtype=np.float32),
+		return_columns=["node_id"],
+		candidate_limit=2,
+		probe=10,
+	)
+
+	assert [[row[1] for row in rows] for rows in results] == [["y", "z"], ["x", "y"]]
+	assert results[1][0][0] == pytest.approx(1 / np.sqrt(1.01), abs=1e-4)
+	assert (
+		postgres_client.search_many_by_vector(
+			table_name="nodes",
+			vector_column="embedding",
+			query_vectors=[],
+			return_columns=["node_id"],
+		)
+		== []
+	)
+
+
+def test_bulk_load_drops_and_rebuilds_the_secondary_indexes(postgres_client):
+	postgres_client.create_table(name="documents", schema=Document.to_sql_schema())
+	table_name = f"{postgres_client.namespace}_documents"
+	index_name = f"{table_name}_file_path_index"
+	postgres_client.connection.execute(
+		f'CREATE INDEX "{index_name}" ON "{table_name}" (file_path)'
+	)
+
+	def table_state():
+		indexes = [
+			name for name, _ in postgres_client.list_secondary_indexes("documents")
+		]
+		persistence = postgres_client.connection.execute(
+			"SELECT relpersistence FROM pg_class WHERE oid = %s::regclass",
+			(f'"{table_name}"',),
+		).fetchone()[0]
+		return indexes, persistence
+
+	with postgres_client.bulk_load(["documents"], unlogged=True):
+		# the primary key backs a constraint, it is kept during the load
+		assert table_state() == ([], "u")
+		postgres_client.bulk_copy(
+			table_name="documents", data=[make_document().model_dump()]
+		)
+
+	assert table_state() == ([index_name], "p")